@@ -3,8 +3,8 @@
 # Mantiene funcionalidades existentes:
 # - Acceso por clave
 # - Descarga del .fydb más reciente desde Drive (Bluecoins/QuickSync)
-# - Búsqueda SOLO en TRANSACTIONSTABLE.notes (con normalización + fuzzy fallback)
-# - Agrupación por componente (closure split) con NewSplitTransactionID (DSU)
+# - Búsqueda en TRANSACTIONSTABLE.notes + comercio (ITEMTABLE.itemName), con normalización + fuzzy fallback
+# - Agrupación por componente (closure split) con NewSplitTransactionID (union-find sobre arreglos)
 # - Filtro "Sólo con boleta" a nivel de componente
 # - Muestra N compras como MÁXIMO (no mínimo) ordenadas por boleta más reciente
 # - Muestra Nota antes de boletas
@@ -16,25 +16,78 @@
 # - Resumen (min/max/prom y consumo mensual) en cabecera, justo después del artículo y antes del loop de boletas
 # - Panel DEBUG opcional
 
-import base64
+import contextvars
+import io
+import json
+import math
 import os
+import random
+import re
 import sqlite3
 import tempfile
+import threading
 import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 import gspread
+from gspread.utils import rowcol_to_a1
+import numpy as np
 import pandas as pd
 import streamlit as st
 import time
-from fuzzywuzzy import fuzz
+from fuzzywuzzy import fuzz, process
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
-from PIL import Image
+from PIL import Image, ImageOps
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # sin rasterizador los PDF quedan sólo para descarga
+    pdfium = None
 
 DEBUG = False
 
+# Cachés locales (compartidas por todas las sesiones del mismo servidor)
+CACHE_DIR = os.environ.get("APP_CACHE_DIR", ".cache_compras")
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots")
+SNAPSHOTS_A_CONSERVAR = 2  # la versión vigente + la anterior (sesiones que aún la leen)
+INDICES_DIR = os.path.join(CACHE_DIR, "indices")  # índices FTS5 derivados de cada snapshot
+LECTURA_CHUNK_FILAS = 50_000  # filas por lote al leer tablas grandes del .fydb
+SNAPSHOT_MMAP_BYTES = 256 * 1024 * 1024  # mmap de la conexión de sólo lectura al .fydb
+# .fydb hasta este tamaño se descarga a memoria y se carga con deserialize (sin pasar por disco)
+SNAPSHOT_MEMORIA_MAX_MB = int(os.environ.get("SNAPSHOT_MEMORIA_MAX_MB", "64"))
+SNAPSHOT_CHUNK_MB = int(os.environ.get("SNAPSHOT_CHUNK_MB", "8"))  # tamaño de cada pedido get_media
+CARPETAS_FILE = os.path.join(CACHE_DIR, "carpetas_drive.json")
+CARPETAS_TTL_S = 7 * 24 * 3600  # los IDs de carpetas casi nunca cambian
+CARPETAS_VALIDACION_S = 15 * 60  # cada cuánto se revalidan en segundo plano
+PICTURES_REFRESCO_S = 60  # refresco incremental del índice de Pictures (Changes API)
+PICTURES_RECARGA_S = 6 * 3600  # listado completo de respaldo
+BOLETAS_DIR = os.path.join(CACHE_DIR, "boletas")
+BOLETAS_CACHE_MAX_MB = int(os.environ.get("BOLETAS_CACHE_MAX_MB", "500"))
+BOLETAS_WORKERS = int(os.environ.get("BOLETAS_WORKERS", "4"))  # descargas simultáneas por proceso
+DERIVADOS_DIR = os.path.join(CACHE_DIR, "derivados")
+DERIVADOS_CACHE_MAX_MB = int(os.environ.get("DERIVADOS_CACHE_MAX_MB", "200"))
+ANCHO_BOLETA = 700  # ancho de la vista de boleta (como app6.py)
+PDF_PAGINAS_VISTA = 1  # páginas rasterizadas para la tarjeta
+PDF_PAGINAS_MAX = 20  # tope al expandir un PDF
+HISTORIAL_DB = os.path.join(CACHE_DIR, "historial.sqlite")  # espejo local de HistorialCompras
+HISTORIAL_SYNC_S = 60  # cada cuánto se revisa si la hoja cambió
+HISTORIAL_MAX_PARCIAL = 200  # sobre esta cantidad de filas cambiadas se relee la hoja completa
+COLA_DB = os.path.join(CACHE_DIR, "cola_escrituras.sqlite")  # guardados pendientes de enviar a Sheets
+COLA_FLUSH_S = 2  # espera máxima antes de enviar un lote
+COLA_BACKOFF_MAX_S = 60
+API_PRESUPUESTO_RERUN = 40  # llamadas Drive/Sheets esperables por rerun (se muestra en DEBUG)
+API_REINTENTOS = 5
+API_BACKOFF_BASE_S = 0.5
+API_BACKOFF_MAX_S = 32
+API_ESTADOS_REINTENTO = {429, 500, 502, 503, 504}
+BUSQUEDAS_CACHE_MAX = 256  # rankings de búsqueda guardados (LRU, compartido entre sesiones)
+CACHE_GRACIA_S = 300  # archivos usados hace menos de esto no se expulsan (otra sesión los está mostrando)
+
 st.title("App Compras Familiares v4")
 
 # Flash message post-rerun
@@ -55,22 +108,49 @@ def normalizar(texto) -> str:
     return texto.lower().strip()
 
 
+def normalizar_serie(serie: pd.Series) -> pd.Series:
+    # Igual a serie.apply(normalizar), pero por columna y sólo sobre valores únicos
+    es_texto = serie.map(lambda x: isinstance(x, str)).astype(bool)
+    # dict.fromkeys y no pd.unique: éste confunde textos que sólo difieren después de un "\x00"
+    unicos = pd.Series(list(dict.fromkeys(serie[es_texto])), dtype=object)
+    normalizados = (
+        unicos.str.normalize("NFKD")
+        .str.encode("ascii", "ignore")
+        .str.decode("utf-8")
+        .str.lower()
+        .str.strip()
+    )
+    mapa = dict(zip(unicos.tolist(), normalizados.tolist()))
+    return serie.where(es_texto).map(mapa).fillna("")
+
+
 def parse_bluecoins_datetime(series: pd.Series) -> pd.Series:
     # La base trae "YYYY-MM-DD HH:MM:SS.0" → remover ".0"
     cleaned = series.astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
     return pd.to_datetime(cleaned, format="%Y-%m-%d %H:%M:%S", errors="coerce")
 
 
+def parsear_numeros(serie: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Convierte una columna con números en formato chileno ("1.234,5") a float en una pasada.
+
+    Los valores que Sheets ya entrega como número se usan tal cual; vacíos → NaN.
+    Devuelve (valores, no_parseables): la segunda serie trae el texto original de las
+    celdas no vacías que no se pudieron leer, para diagnóstico.
+    """
+    es_num = serie.map(lambda v: isinstance(v, (int, float, np.number)) and not isinstance(v, bool))
+    texto = serie.where(~es_num & serie.notna(), "").astype(str).str.strip()
+    # tolerante a separadores: "." de miles fuera, "," decimal → "."
+    limpio = texto.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    valores = pd.to_numeric(limpio, errors="coerce")
+    valores[es_num] = serie[es_num].astype(float)
+    no_parseables = serie[valores.isna() & (texto != "")]
+    return valores.astype(float), no_parseables
+
+
 def to_float(x):
-    try:
-        s = str(x).strip()
-        if s == "":
-            return None
-        # tolerante a separadores
-        s = s.replace(".", "").replace(",", ".")
-        return float(s)
-    except Exception:
-        return None
+    # Un solo valor, mismas reglas que parsear_numeros
+    v = parsear_numeros(pd.Series([x], dtype=object))[0].iloc[0]
+    return None if pd.isna(v) else float(v)
 
 def formatear_pesos(valor):
     try:
@@ -89,6 +169,126 @@ if password_input != PASSWORD:
 st.success("¡Bienvenida/o!")
 
 
+# -------------------------
+# Cliente Google compartido (backoff, coalescencia, presupuesto por rerun)
+# -------------------------
+class PresupuestoLlamadas:
+    def __init__(self, limite: int):
+        self.limite = limite
+        self.usadas = 0
+        self.lock = threading.Lock()
+
+    def registrar(self):
+        with self.lock:
+            self.usadas += 1
+
+    @property
+    def excedido(self) -> bool:
+        return self.usadas > self.limite
+
+
+def _estado_http(e: Exception) -> int | None:
+    if isinstance(e, HttpError):
+        return e.resp.status
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(getattr(e, "response", None), "status_code", None)
+    return None
+
+
+def _es_rechazo(e: Exception) -> bool:
+    """429 / 403 por cuota: el servidor rechazó el pedido sin aplicarlo."""
+    estado = _estado_http(e)
+    if estado == 403:
+        return "rateLimitExceeded" in str(e) or "userRateLimitExceeded" in str(e)
+    return estado == 429
+
+
+def _es_reintentable(e: Exception) -> bool:
+    if _es_rechazo(e):
+        return True
+    if _estado_http(e) is not None:
+        return _estado_http(e) in API_ESTADOS_REINTENTO
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+class ClienteGoogle:
+    """Punto único para llamadas Drive/Sheets compartido por todas las sesiones.
+
+    - Reintenta 429/5xx con backoff exponencial y jitter (las no idempotentes, sólo 429/cuota).
+    - Coalesce: llamadas idénticas (misma clave) en vuelo desde varias sesiones → una sola.
+    - Cuenta llamadas contra el presupuesto del rerun actual (ContextVar).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.en_vuelo: dict = {}
+        self.presupuesto = contextvars.ContextVar("presupuesto_api", default=None)
+        self.stats = {"llamadas": 0, "reintentos": 0, "coalescidas": 0, "fallidas": 0}
+
+    def _contar(self, campo: str):
+        with self.lock:
+            self.stats[campo] += 1
+
+    def _con_reintentos(self, fn, idempotente: bool):
+        # Un 5xx o un timeout no dicen si el pedido se aplicó: repetir un append podría duplicarlo
+        reintentable = _es_reintentable if idempotente else _es_rechazo
+        for intento in range(API_REINTENTOS + 1):
+            try:
+                return fn()
+            except Exception as e:
+                if intento == API_REINTENTOS or not reintentable(e):
+                    self._contar("fallidas")
+                    raise
+                self._contar("reintentos")
+                espera = min(API_BACKOFF_MAX_S, API_BACKOFF_BASE_S * 2 ** intento)
+                time.sleep(espera * random.uniform(0.5, 1.5))
+
+    def llamar(self, fn, clave=None, idempotente: bool = True):
+        """Ejecuta fn() con reintentos. Con clave, los resultados se comparten: tratarlos como sólo lectura."""
+        futuro = None
+        if clave is not None:
+            with self.lock:
+                en_curso = self.en_vuelo.get(clave)
+                if en_curso is None:
+                    futuro = self.en_vuelo[clave] = Future()
+            if en_curso is not None:
+                self._contar("coalescidas")
+                return en_curso.result()
+
+        presupuesto = self.presupuesto.get()
+        if presupuesto is not None:
+            presupuesto.registrar()
+        self._contar("llamadas")
+        try:
+            resultado = self._con_reintentos(fn, idempotente)
+        except Exception as e:
+            if futuro is not None:
+                futuro.set_exception(e)
+            raise
+        else:
+            if futuro is not None:
+                futuro.set_result(resultado)
+            return resultado
+        finally:
+            if futuro is not None:
+                with self.lock:
+                    self.en_vuelo.pop(clave, None)
+
+    def estadisticas(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+
+@st.cache_resource
+def cliente_google() -> ClienteGoogle:
+    return ClienteGoogle()
+
+
+api = cliente_google()
+presupuesto_rerun = PresupuestoLlamadas(API_PRESUPUESTO_RERUN)
+api.presupuesto.set(presupuesto_rerun)
+
+
 # -------------------------
 # Google Drive / Sheets
 # -------------------------
@@ -106,7 +306,7 @@ SCOPES = ["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/a
 credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
 drive_service = build("drive", "v3", credentials=credentials)
 gc = gspread.authorize(credentials)
-worksheet = gc.open_by_key(st.secrets["SHEETS_ID"]).sheet1
+worksheet = api.llamar(lambda: gc.open_by_key(st.secrets["SHEETS_ID"]).sheet1)
 
 
 # -------------------------
@@ -127,437 +327,1792 @@ def dbg_df(title: str, df: pd.DataFrame, n: int = 50):
         st.sidebar.dataframe(df.head(n))
 
 
+# Panel de llamadas a Google: se reserva arriba y se completa al final del rerun o al detenerlo
+panel_api = st.sidebar.empty()
+
+
+def mostrar_panel_api():
+    if DEBUG:
+        with panel_api.container():
+            st.markdown("**API Google**")
+            st.write({
+                "rerun": f"{presupuesto_rerun.usadas}/{presupuesto_rerun.limite}",
+                "excedido": presupuesto_rerun.excedido,
+                **api.estadisticas(),
+            })
+
+
+def detener():
+    # st.stop() que igual muestra el consumo de API del rerun
+    mostrar_panel_api()
+    st.stop()
+
+
 # -------------------------
 # Sheets helpers (HistorialCompras)
 # -------------------------
-# --- 1. CARGAR HISTORIAL (Mejorado para identificar filas exactas) ---
-@st.cache_data(ttl=60)
-def cargar_historial(_worksheet):
-    values = _worksheet.get_all_values()
-    if not values or len(values) < 2:
-        return pd.DataFrame(), {}
-
-    headers = values[0]
-    rows = values[1:]
-    df = pd.DataFrame(rows, columns=headers)
-    # Guardamos la fila real de Sheets (indice 0 es fila 1, por eso sumamos 2)
-    df["_row_number"] = range(2, 2 + len(df)) 
-
-    if "Producto buscado" in df.columns:
-        df["prod_norm"] = df["Producto buscado"].apply(normalizar)
-    else:
-        df["prod_norm"] = ""
-
-    # Creamos un diccionario de búsqueda rápida: (producto_norm, tid) -> fila_sheets
-    row_by_key = {}
-    if "Producto buscado" in df.columns and "transactionsTableID" in df.columns:
-        for idx, row in df.iterrows():
-            p_norm = normalizar(row["Producto buscado"])
-            tid_str = str(row["transactionsTableID"]).strip()
-            if tid_str:
-                row_by_key[(p_norm, tid_str)] = int(row["_row_number"])
+# --- 1. ESPEJO LOCAL DEL HISTORIAL (SQLite, sincronización incremental) ---
+def _como_texto_sheets(v) -> str:
+    # Números como los muestra Sheets en es-CL (coma decimal), para que parsear_numeros los lea igual
+    if isinstance(v, float):
+        return f"{v:.10g}".replace(".", ",")
+    return "" if v is None else str(v)
+
+
+class EspejoHistorial:
+    """Copia local de HistorialCompras. Se sincronizan sólo filas nuevas o cambiadas,
+    detectadas por la cantidad de filas y la columna "Última modificación"."""
+
+    COL_MODIF = "Última modificación"
+    RESUMEN_VERSION = "2"  # subir si cambian las tablas derivadas (resumen, no_numericas)
+
+    def __init__(self, ruta_db: str, sheet_id: str):
+        os.makedirs(os.path.dirname(ruta_db), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(ruta_db, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+            CREATE TABLE IF NOT EXISTS filas (
+                fila INTEGER PRIMARY KEY, datos TEXT, prod_norm TEXT, tid TEXT, modif TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_filas_clave ON filas (prod_norm, tid);
+            CREATE TABLE IF NOT EXISTS resumen (
+                prod_norm TEXT, unidad TEXT,
+                filas INTEGER,                -- filas con esa unidad (elige la unidad más frecuente)
+                compras INTEGER, suma_pc REAL, suma_c REAL, precio_min REAL, precio_max REAL,
+                fecha_ini TEXT, fecha_fin TEXT,
+                consumo_n INTEGER, consumo_suma_c REAL, consumo_ini TEXT, consumo_fin TEXT, cant_ultima REAL,
+                PRIMARY KEY (prod_norm, unidad)
+            );
+            -- Celdas Precio/Cantidad que no se pudieron leer como número (diagnóstico)
+            CREATE TABLE IF NOT EXISTS no_numericas (fila INTEGER, prod_norm TEXT, columna TEXT, valor TEXT);
+            CREATE INDEX IF NOT EXISTS idx_no_numericas_prod ON no_numericas (prod_norm);
+            """
+        )
+        if self._meta("sheet_id") != sheet_id:
+            self._reiniciar()
+            self._set_meta("sheet_id", sheet_id)
+        if self._meta("resumen_version") != self.RESUMEN_VERSION:
+            with self.conn:  # espejo creado con otra versión de las tablas derivadas
+                self._recalcular_resumen(None)
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('resumen_version', ?)", (self.RESUMEN_VERSION,))
+        self.ultimo_sync = 0.0
+        self.version = 0
+        self._claves_cache = None  # (versión, row_by_key, registro_by_key)
+        self.optimistas: dict[int, str] = {}  # filas escritas localmente y aún no confirmadas en Sheets
+
+    # --- meta ---
+    def _meta(self, clave: str):
+        r = self.conn.execute("SELECT valor FROM meta WHERE clave = ?", (clave,)).fetchone()
+        return r[0] if r else None
+
+    def _set_meta(self, clave: str, valor):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (clave, valor))
+
+    def _reiniciar(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM filas")
+            self.conn.execute("DELETE FROM resumen")
+            self.conn.execute("DELETE FROM no_numericas")
+            self.conn.execute("DELETE FROM meta")
+
+    @property
+    def headers(self) -> list[str]:
+        return json.loads(self._meta("headers") or "[]")
+
+    # --- escritura local ---
+    def _registro(self, fila: int, valores: list, headers: list[str]) -> tuple:
+        valores = (list(valores) + [""] * len(headers))[: len(headers)]
+        d = dict(zip(headers, valores))
+        prod_norm = normalizar(d.get("Producto buscado", ""))
+        tid = str(d.get("transactionsTableID", "")).strip()
+        return fila, json.dumps(valores, ensure_ascii=False), prod_norm, tid, str(d.get(self.COL_MODIF, ""))
+
+    def _guardar_filas(self, filas: dict[int, list], headers: list[str], completo: bool = False):
+        registros = [self._registro(f, v, headers) for f, v in filas.items()]
+        with self.conn:
+            afectados = None
+            if not completo:
+                # Productos que pierden la fila (valor anterior) y que la ganan (valor nuevo)
+                numeros = list(filas)
+                afectados = {r[2] for r in registros}
+                for i in range(0, len(numeros), 500):
+                    trozo = numeros[i : i + 500]
+                    afectados.update(
+                        p for (p,) in self.conn.execute(
+                            f"SELECT prod_norm FROM filas WHERE fila IN ({','.join('?' * len(trozo))})", trozo
+                        )
+                    )
+            self.conn.executemany("INSERT OR REPLACE INTO filas VALUES (?, ?, ?, ?, ?)", registros)
+            self._recalcular_resumen(afectados)
+
+    def _recalcular_resumen(self, prods: set[str] | None):
+        """Recalcula el resumen de los productos indicados (None = todos). Llamar dentro de una transacción."""
+        headers = self.headers
+        if not all(c in headers for c in ("Unidad", "Precio", "Cantidad", "Fecha")):
+            self.conn.execute("DELETE FROM resumen")
+            self.conn.execute("DELETE FROM no_numericas")
+            return
+        cols = ", ".join(f"json_extract(datos, '$[{headers.index(c)}]')" for c in ("Unidad", "Precio", "Cantidad", "Fecha"))
+        consulta = f"SELECT fila, prod_norm, {cols} FROM filas"
+        if prods is None:
+            self.conn.execute("DELETE FROM resumen")
+            self.conn.execute("DELETE FROM no_numericas")
+            filas = self.conn.execute(consulta).fetchall()
+        else:
+            prods = list(prods)
+            if not prods:
+                return
+            filas = []
+            for i in range(0, len(prods), 500):
+                trozo = prods[i : i + 500]
+                marcas = ",".join("?" * len(trozo))
+                self.conn.execute(f"DELETE FROM resumen WHERE prod_norm IN ({marcas})", trozo)
+                self.conn.execute(f"DELETE FROM no_numericas WHERE prod_norm IN ({marcas})", trozo)
+                filas += self.conn.execute(f"{consulta} WHERE prod_norm IN ({marcas})", trozo).fetchall()
+        if not filas:
+            return
+        df = pd.DataFrame(filas, columns=["fila", "prod_norm", "Unidad", "Precio", "Cantidad", "Fecha"])
+        res, invalidos = calcular_resumen(df)
+        self.conn.executemany(
+            "INSERT INTO no_numericas VALUES (?, ?, ?, ?)",
+            [(int(f), p, col, str(val)) for f, p, col, val in invalidos.itertuples(index=False, name=None)],
+        )
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO resumen ({', '.join(res.columns)}) VALUES ({','.join('?' * len(res.columns))})",
+            res.itertuples(index=False, name=None),
+        )
+
+    def _sync_completo(self, ws):
+        values = api.llamar(ws.get_all_values)
+        headers = values[0] if values else []
+        with self.conn:
+            self.conn.execute("DELETE FROM filas")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('headers', ?)", (json.dumps(headers),))
+        self._guardar_filas({i + 2: row for i, row in enumerate(values[1:])}, headers, completo=True)
+
+    def _sync_incremental(self, ws) -> bool:
+        """True si pudo sincronizar por diferencias; False si hace falta releer todo."""
+        headers = self.headers
+        if self.COL_MODIF not in headers or "Producto buscado" not in headers:
+            return False
+        col_modif = headers.index(self.COL_MODIF) + 1
+        col_prod = headers.index("Producto buscado") + 1
+        letra = lambda c: rowcol_to_a1(1, c)[:-1]
+        rangos = ["1:1", f"{letra(col_prod)}:{letra(col_prod)}", f"{letra(col_modif)}:{letra(col_modif)}"]
+        cab, col_p, col_m = api.llamar(lambda: ws.batch_get(rangos))
+        if not cab or list(cab[0]) != headers[: len(cab[0])]:
+            return False  # cambió la cabecera
+
+        prods = [r[0] if r else "" for r in col_p]
+        modifs = [r[0] if r else "" for r in col_m]
+        n_filas = max(len(prods), len(modifs))  # incluye la cabecera
+        prods += [""] * (n_filas - len(prods))
+        modifs += [""] * (n_filas - len(modifs))
+
+        locales = {
+            f: (p, m) for f, p, m in self.conn.execute(
+                "SELECT fila, json_extract(datos, ?), modif FROM filas", (f"$[{col_prod - 1}]",)
+            )
+        }
+        if locales and max(locales) > n_filas:
+            return False  # se borraron filas: la numeración cambió
 
-    return df, row_by_key
+        cambiadas = [
+            f for f in range(2, n_filas + 1)
+            if f not in self.optimistas and locales.get(f) != (prods[f - 1], modifs[f - 1])
+        ]
+        if not cambiadas:
+            return True
+        if len(cambiadas) > HISTORIAL_MAX_PARCIAL:
+            return False
+
+        ultima = len(headers)
+        rangos = [f"{rowcol_to_a1(f, 1)}:{rowcol_to_a1(f, ultima)}" for f in cambiadas]
+        nuevos = api.llamar(lambda: ws.batch_get(rangos))
+        self._guardar_filas({f: (vr[0] if vr else []) for f, vr in zip(cambiadas, nuevos)}, headers)
+        return True
+
+    def sincronizar(self, ws, forzar: bool = False):
+        with self.lock:
+            if not forzar and time.time() - self.ultimo_sync < HISTORIAL_SYNC_S:
+                return
+            antes = self.conn.total_changes
+            if not self._sync_incremental(ws):
+                self._sync_completo(ws)
+            self.ultimo_sync = time.time()
+            if self.conn.total_changes != antes:
+                self.version += 1
+
+    def aplicar_escritura(self, fila: int, valores: list, optimista: bool = False):
+        """Aplica una escritura conocida (fila + valores) al espejo y a los diccionarios en memoria, sin releer Sheets."""
+        with self.lock:
+            headers = self.headers
+            if not headers:
+                return  # espejo aún vacío: la próxima sincronización lo trae completo
+            valores = [_como_texto_sheets(v) for v in valores]
+            reg = self._registro(fila, valores, headers)
+            previa = self.conn.execute("SELECT prod_norm, tid FROM filas WHERE fila = ?", (fila,)).fetchone()
+            self._guardar_filas({fila: valores}, headers)
+            if optimista:
+                self.optimistas[fila] = reg[4]
+            else:
+                self.optimistas.pop(fila, None)
+            self.version += 1
+
+            if not self._claves_cache:
+                return  # se reconstruye desde SQLite en la próxima lectura
+            # Copias: otras sesiones pueden estar leyendo los diccionarios anteriores
+            row_by_key, registro_by_key = dict(self._claves_cache[1]), dict(self._claves_cache[2])
+            for clave in {tuple(previa) if previa else None, (reg[2], reg[3])} - {None}:
+                if not clave[1]:
+                    continue
+                # La fila más alta del par manda (puede ser otra si esta fila cambió de producto/tid)
+                r = self.conn.execute(
+                    "SELECT fila, datos FROM filas WHERE prod_norm = ? AND tid = ? ORDER BY fila DESC LIMIT 1", clave
+                ).fetchone()
+                if r:
+                    row_by_key[clave] = r[0]
+                    registro_by_key[clave] = self._registro_dict(r[0], r[1], clave[0], headers)
+                else:
+                    row_by_key.pop(clave, None)
+                    registro_by_key.pop(clave, None)
+            self._claves_cache = (self.version, row_by_key, registro_by_key)
+
+    def invalidar(self):
+        # La próxima lectura revisa la hoja aunque no haya pasado HISTORIAL_SYNC_S
+        with self.lock:
+            self.ultimo_sync = 0.0
+
+    # --- lectura local ---
+    def diagnostico_numeros(self) -> dict:
+        with self.lock:
+            total = self.conn.execute("SELECT COUNT(*) FROM no_numericas").fetchone()[0]
+            ejemplos = self.conn.execute(
+                "SELECT prod_norm, fila, columna, valor FROM no_numericas ORDER BY fila LIMIT 10"
+            ).fetchall()
+        return {"no_numericas": total, "ejemplos": ejemplos}
+
+    def resumen_producto(self, prod_norm: str) -> tuple[bool, dict | None]:
+        """(hay historial?, resumen de la unidad más frecuente) leído de la tabla materializada."""
+        with self.lock:
+            hay = self.conn.execute("SELECT 1 FROM filas WHERE prod_norm = ? LIMIT 1", (prod_norm,)).fetchone()
+            cur = self.conn.execute(
+                "SELECT * FROM resumen WHERE prod_norm = ? ORDER BY filas DESC, unidad LIMIT 1", (prod_norm,)
+            )
+            r = cur.fetchone()
+        if not r:
+            return bool(hay), None
+        res = dict(zip([c[0] for c in cur.description], r))
+        for c in ("fecha_ini", "fecha_fin", "consumo_ini", "consumo_fin"):
+            res[c] = pd.Timestamp(res[c]) if res[c] else pd.NaT
+        return True, res
+
+    @staticmethod
+    def _registro_dict(fila: int, datos: str, prod_norm: str, headers: list[str]) -> dict:
+        registro = dict(zip(headers, json.loads(datos)))
+        registro["_row_number"] = fila
+        registro["prod_norm"] = prod_norm
+        return registro
+
+    def claves(self) -> tuple[dict, dict]:
+        """(row_by_key, registro_by_key): (producto_norm, tid) -> fila de Sheets / registro de esa fila."""
+        with self.lock:
+            if self._claves_cache and self._claves_cache[0] == self.version:
+                return self._claves_cache[1:]
+            headers = self.headers
+            datos_by_key = {}
+            row_by_key = {}
+            # ORDER BY fila: si el par se repite, queda la última fila
+            for p, t, f, d in self.conn.execute(
+                "SELECT prod_norm, tid, fila, datos FROM filas WHERE tid != '' ORDER BY fila"
+            ):
+                row_by_key[(p, t)] = f
+                datos_by_key[(p, t)] = d
+            registro_by_key = {
+                k: self._registro_dict(row_by_key[k], d, k[0], headers) for k, d in datos_by_key.items()
+            }
+            self._claves_cache = (self.version, row_by_key, registro_by_key)
+            return row_by_key, registro_by_key
+
+
+@st.cache_resource
+def espejo_historial(sheet_id: str) -> EspejoHistorial:
+    return EspejoHistorial(HISTORIAL_DB, sheet_id)
+
+
+def cargar_historial(_worksheet, forzar: bool = False):
+    espejo = espejo_historial(st.secrets["SHEETS_ID"])
+    espejo.sincronizar(_worksheet, forzar=forzar)
+    return espejo.claves()
+
+
+# --- 1b. COLA DE ESCRITURAS (write-behind, lotes a Sheets) ---
+class ColaEscrituras:
+    """Registra los guardados localmente y los envía a Sheets en lotes desde un hilo propio.
+
+    Un guardado pendiente para el mismo (producto_norm, tid) se reemplaza (no se duplica).
+    """
+
+    def __init__(self, ruta_db: str, sheet_id: str, espejo: EspejoHistorial):
+        os.makedirs(os.path.dirname(ruta_db), exist_ok=True)
+        self.sheet_id = sheet_id
+        self.espejo = espejo
+        self.lock = threading.Lock()
+        self.evento = threading.Event()
+        self.reconciliar_en = 0.0
+        self.appends_inciertos = False  # un append falló sin saber si Sheets lo aplicó
+        self.conn = sqlite3.connect(ruta_db, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cola (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sheet_id TEXT, prod_norm TEXT, tid TEXT,
+                    fila INTEGER,              -- fila destino (update) o asignada por append
+                    datos TEXT,                -- JSON de la fila A:J
+                    estado TEXT,               -- pendiente | confirmado
+                    intentos INTEGER DEFAULT 0,
+                    error TEXT,
+                    creado REAL, confirmado REAL
+                )
+                """
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cola_clave ON cola (sheet_id, prod_norm, tid)")
+        threading.Thread(target=self._bucle, daemon=True, name="cola-sheets").start()
+
+    def encolar(self, prod_norm: str, tid: str, fila: int | None, valores: list):
+        with self.lock, self.conn:
+            previo = self.conn.execute(
+                "SELECT id, fila FROM cola WHERE sheet_id = ? AND prod_norm = ? AND tid = ? AND estado = 'pendiente'",
+                (self.sheet_id, prod_norm, tid),
+            ).fetchone()
+            if previo:
+                self.conn.execute(
+                    "UPDATE cola SET datos = ?, fila = ?, creado = ? WHERE id = ?",
+                    (json.dumps(valores, ensure_ascii=False), fila or previo[1], time.time(), previo[0]),
+                )
+            else:
+                self.conn.execute(
+                    "INSERT INTO cola (sheet_id, prod_norm, tid, fila, datos, estado, creado) VALUES (?, ?, ?, ?, ?, 'pendiente', ?)",
+                    (self.sheet_id, prod_norm, tid, fila, json.dumps(valores, ensure_ascii=False), time.time()),
+                )
+        if fila:
+            # Update: la fila ya se conoce → el historial local refleja el cambio de inmediato
+            self.espejo.aplicar_escritura(fila, valores, optimista=True)
+        self.evento.set()
+
+    def estado(self, prod_norm: str, tid: str) -> dict | None:
+        """Último guardado registrado para el par: {estado, fila, error, intentos}."""
+        with self.lock:
+            r = self.conn.execute(
+                "SELECT estado, fila, error, intentos FROM cola WHERE sheet_id = ? AND prod_norm = ? AND tid = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (self.sheet_id, prod_norm, tid),
+            ).fetchone()
+        return dict(zip(["estado", "fila", "error", "intentos"], r)) if r else None
+
+    def pendientes(self) -> int:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM cola WHERE sheet_id = ? AND estado = 'pendiente'", (self.sheet_id,)
+            ).fetchone()[0]
+
+    # --- hilo de envío ---
+    def _bucle(self):
+        ws = None
+        espera = 0.0
+        while True:
+            self.evento.wait(timeout=max(COLA_FLUSH_S, espera))
+            self.evento.clear()
+            try:
+                if ws is None:
+                    ws = api.llamar(lambda: gspread.authorize(credentials).open_by_key(self.sheet_id).sheet1)
+                self._enviar_lote(ws)
+                if self.reconciliar_en and time.time() >= self.reconciliar_en:
+                    # Conciliación perezosa: cambios hechos por otros (u otras apps) sobre la hoja
+                    self.reconciliar_en = 0.0
+                    self.espejo.sincronizar(ws, forzar=True)
+                espera = 0.0
+            except Exception as e:
+                # Reintento con backoff exponencial; el error queda visible en la tarjeta
+                espera = min(COLA_BACKOFF_MAX_S, max(COLA_FLUSH_S, espera * 2))
+                with self.lock, self.conn:
+                    self.conn.execute(
+                        "UPDATE cola SET intentos = intentos + 1, error = ? WHERE sheet_id = ? AND estado = 'pendiente'",
+                        (str(e)[:300], self.sheet_id),
+                    )
+
+    def _buscar_en_hoja(self, ws, appends: list) -> dict[int, int]:
+        """id -> fila de los appends que ya están en la hoja (mismo tid y misma "Última modificación")."""
+        col_tid, col_modif = api.llamar(lambda: ws.batch_get(["B:B", "J:J"]))
+        n = max(len(col_tid), len(col_modif))
+        col_tid = [r[0] if r else "" for r in col_tid] + [""] * (n - len(col_tid))
+        col_modif = [r[0] if r else "" for r in col_modif] + [""] * (n - len(col_modif))
+        buscadas = {(str(v[1]), str(v[9])): i for i, v in appends}
+        encontradas = {}
+        for f in range(n, 0, -1):  # desde el final: un append perdido queda en la cola de la hoja
+            i = buscadas.pop((col_tid[f - 1], col_modif[f - 1]), None)
+            if i is not None:
+                encontradas[i] = f
+            if not buscadas:
+                break
+        return encontradas
+
+    def _enviar_lote(self, ws):
+        with self.lock:
+            lote = self.conn.execute(
+                "SELECT id, fila, datos, creado FROM cola WHERE sheet_id = ? AND estado = 'pendiente' ORDER BY id",
+                (self.sheet_id,),
+            ).fetchall()
+        if not lote:
+            return
+        # creado identifica la versión enviada: encolar puede reemplazar los datos mientras el lote está en vuelo
+        version = {i: c for i, _, _, c in lote}
+        updates = [(i, f, json.loads(d)) for i, f, d, _ in lote if f]
+        appends = [(i, json.loads(d)) for i, f, d, _ in lote if not f]
+        confirmadas = []  # (id, fila, valores)
+
+        if updates:
+            api.llamar(lambda: ws.batch_update([{"range": f"A{f}:J{f}", "values": [v]} for _, f, v in updates]))
+            confirmadas += updates
+        if appends and self.appends_inciertos:
+            ya_escritas = self._buscar_en_hoja(ws, appends)
+            confirmadas += [(i, ya_escritas[i], v) for i, v in appends if i in ya_escritas]
+            appends = [(i, v) for i, v in appends if i not in ya_escritas]
+            self.appends_inciertos = False
+        if appends:
+            try:
+                res = api.llamar(
+                    lambda: ws.append_rows([v for _, v in appends], value_input_option="RAW", table_range="A1"),
+                    idempotente=False,
+                )
+            except Exception as e:
+                if not _es_rechazo(e):
+                    self.appends_inciertos = True  # antes de reenviar, revisar si quedaron escritas
+                raise
+            # updatedRange: "'Hoja 1'!A12:J14" → filas asignadas en orden
+            rango = res.get("updates", {}).get("updatedRange", "")
+            m = re.search(r"[A-Z]+(\d+)(?::[A-Z]+\d+)?$", rango)
+            primera = int(m.group(1)) if m else None
+            confirmadas += [(i, primera + k if primera else None, v) for k, (i, v) in enumerate(appends)]
+
+        ahora = time.time()
+        with self.lock, self.conn:
+            # La fila asignada se guarda siempre: si los datos cambiaron en vuelo, el reenvío es un update, no otro append
+            self.conn.executemany(
+                "UPDATE cola SET fila = ? WHERE id = ? AND fila IS NULL",
+                [(f, i) for i, f, _ in confirmadas if f],
+            )
+            vigentes = set()
+            for i, f, _ in confirmadas:
+                cur = self.conn.execute(
+                    "UPDATE cola SET estado = 'confirmado', error = NULL, confirmado = ? WHERE id = ? AND creado = ?",
+                    (ahora, i, version[i]),
+                )
+                if cur.rowcount:
+                    vigentes.add(i)
+        if len(vigentes) < len(confirmadas):
+            self.evento.set()  # hay datos más nuevos pendientes de enviar
+
+        # La respuesta ya dice qué fila quedó escrita: se aplica en el espejo sin releer la hoja
+        for i, f, v in confirmadas:
+            if i not in vigentes:
+                continue  # reemplazado en vuelo: el espejo ya tiene (o tendrá) los datos nuevos
+            if f:
+                self.espejo.aplicar_escritura(f, v)
+            else:
+                self.espejo.invalidar()  # respuesta sin rango: que la próxima lectura sincronice
+        self.reconciliar_en = time.time() + HISTORIAL_SYNC_S
 
-# --- 2. CÁLCULO DE RESUMEN (Promedio Ponderado y Consumo Mensual) ---
-def calcular_resumen(df_hist_prod: pd.DataFrame, unidad: str):
-    if df_hist_prod.empty: return None
-    
-    unidad = str(unidad).strip()
-    sub = df_hist_prod[df_hist_prod["Unidad"].astype(str).str.strip() == unidad].copy()
-    
-    sub["Precio_f"] = sub["Precio"].apply(to_float)
-    sub["Cantidad_f"] = sub["Cantidad"].apply(to_float)
-    sub["Fecha_dt"] = pd.to_datetime(sub["Fecha"], errors="coerce")
-    sub = sub.dropna(subset=["Precio_f", "Cantidad_f", "Fecha_dt"])
-    sub = sub[(sub["Precio_f"] > 0) & (sub["Cantidad_f"] > 0)]
-    
-    if sub.empty: return None
 
-    # Métricas solicitadas
-    precio_min = float(sub["Precio_f"].min())
-    precio_max = float(sub["Precio_f"].max())
-    
-    # Promedio Ponderado: sum(P*C) / sum(C)
-    suma_pc = (sub["Precio_f"] * sub["Cantidad_f"]).sum()
-    suma_c = sub["Cantidad_f"].sum()
-    precio_prom_ponderado = suma_pc / suma_c
+@st.cache_resource
+def cola_escrituras(sheet_id: str) -> ColaEscrituras:
+    return ColaEscrituras(COLA_DB, sheet_id, espejo_historial(sheet_id))
 
-    # Consumo Mensual: sum(Cant) / (rango dias / 30.44)
-    f_ini, f_fin = sub["Fecha_dt"].min(), sub["Fecha_dt"].max()
-    dias = max(1, (f_fin - f_ini).days)
-    meses = dias / 30.44
-    consumo_mensual = suma_c / max(0.03, meses) # Evitar division por casi cero
 
-    return {
-        "unidad": unidad,
-        "periodo_ini": f_ini,
-        "periodo_fin": f_fin,
-        "compras": len(sub),
-        "precio_min": precio_min,
-        "precio_max": precio_max,
-        "precio_prom": precio_prom_ponderado,
-        "consumo_mensual": consumo_mensual
-    }
+# --- 2. CÁLCULO DE RESUMEN (Promedio Ponderado y Consumo Mensual) ---
+def calcular_resumen(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Agregados por (prod_norm, unidad) para la tabla `resumen` del espejo.
+
+    df: columnas fila, prod_norm, Unidad, Precio, Cantidad, Fecha (texto tal como viene de Sheets).
+    Devuelve (resumen, celdas Precio/Cantidad no numéricas: fila, prod_norm, columna, valor).
+    """
+    df = df.copy()
+    df["unidad"] = df["Unidad"].fillna("").astype(str).str.strip()
+    df = df[df["unidad"] != ""]
+    claves = ["prod_norm", "unidad"]
+    if df.empty:
+        return pd.DataFrame(columns=[
+            *claves, "filas", "compras", "suma_pc", "suma_c", "precio_min", "precio_max", "fecha_ini", "fecha_fin",
+            "consumo_n", "consumo_suma_c", "consumo_ini", "consumo_fin", "cant_ultima",
+        ]), pd.DataFrame(columns=["fila", "prod_norm", "columna", "valor"])
+
+    df["Precio_f"], malos_p = parsear_numeros(df["Precio"])
+    df["Cantidad_f"], malos_c = parsear_numeros(df["Cantidad"])
+    invalidos = pd.concat([
+        df.loc[m.index, ["fila", "prod_norm"]].assign(columna=col, valor=m)
+        for col, m in (("Precio", malos_p), ("Cantidad", malos_c))
+    ], ignore_index=True)
+    # Fechas por (producto, unidad), como antes: pandas infiere el formato de la primera fila, y
+    # parsear la columna entera haría depender cada producto de la primera fila de la hoja
+    df["Fecha_dt"] = pd.NaT
+    for idx in df.groupby(claves, sort=False).indices.values():
+        df.iloc[idx, df.columns.get_loc("Fecha_dt")] = pd.to_datetime(df["Fecha"].iloc[idx], errors="coerce")
+    df["Fecha_dt"] = pd.to_datetime(df["Fecha_dt"])
+    res = df.groupby(claves).size().rename("filas").to_frame()
+
+    # Consumo: compras con cantidad y fecha válidas; la última (por fecha) se resta al mostrar
+    cons = df[df["Cantidad_f"].gt(0) & df["Fecha_dt"].notna()].sort_values(["Fecha_dt", "fila"])
+    g = cons.groupby(claves)
+    res = res.join(pd.DataFrame({
+        "consumo_n": g.size(),
+        "consumo_suma_c": g["Cantidad_f"].sum(),
+        "consumo_ini": g["Fecha_dt"].min(),
+        "consumo_fin": g["Fecha_dt"].max(),
+        "cant_ultima": g["Cantidad_f"].last(),
+    }))
+
+    # Precio: además precio > 0. Promedio ponderado = suma(P*C) / suma(C)
+    pre = cons[cons["Precio_f"].gt(0)].assign(pc=lambda d: d["Precio_f"] * d["Cantidad_f"])
+    g = pre.groupby(claves)
+    res = res.join(pd.DataFrame({
+        "compras": g.size(),
+        "suma_pc": g["pc"].sum(),
+        "suma_c": g["Cantidad_f"].sum(),
+        "precio_min": g["Precio_f"].min(),
+        "precio_max": g["Precio_f"].max(),
+        "fecha_ini": g["Fecha_dt"].min(),
+        "fecha_fin": g["Fecha_dt"].max(),
+    }))
+
+    for c in ("compras", "consumo_n"):
+        res[c] = res[c].fillna(0).astype(int)
+    for c in ("fecha_ini", "fecha_fin", "consumo_ini", "consumo_fin"):
+        res[c] = res[c].dt.strftime("%Y-%m-%d %H:%M:%S")
+    res = res.reset_index().astype(object)
+    return res.where(res.notna(), None), invalidos
 
 # -------------------------
 # Drive helpers
 # -------------------------
-def buscar_carpeta(nombre: str, parent_id: str | None = None) -> str | None:
+def buscar_carpeta(nombre: str, parent_id: str | None = None, service=None) -> str | None:
     q = f"name = '{nombre}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
     if parent_id:
         q += f" and '{parent_id}' in parents"
-    results = drive_service.files().list(q=q, fields="files(id, name)").execute()
+    service = service or drive_service
+    results = api.llamar(lambda: service.files().list(q=q, fields="files(id, name)").execute(), clave=("files.list", q))
     files = results.get("files", [])
     return files[0]["id"] if files else None
 
 
-bluecoins_id = buscar_carpeta("Bluecoins")
-quicksync_id = buscar_carpeta("QuickSync", parent_id=bluecoins_id) if bluecoins_id else None
-pictures_id = buscar_carpeta("Pictures", parent_id=bluecoins_id) if bluecoins_id else None
+# --- Caché persistente de IDs de carpetas (Bluecoins / QuickSync / Pictures) ---
+@st.cache_resource
+def estado_carpetas() -> dict:
+    return {"lock": threading.Lock(), "ids": None, "ts": 0.0, "validado": 0.0}
+
+
+def leer_cache_carpetas() -> tuple[dict, float]:
+    try:
+        with open(CARPETAS_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}, 0.0
+    ts = float(data.get("ts", 0))
+    if time.time() - ts > CARPETAS_TTL_S:
+        return {}, 0.0
+    return data.get("ids", {}), ts
+
+
+def guardar_cache_carpetas(ids: dict, ts: float):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = CARPETAS_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ts": ts, "ids": ids}, f)
+    os.replace(tmp, CARPETAS_FILE)
+
+
+def invalidar_carpetas(estado: dict):
+    # estado = estado_carpetas(), resuelto en el hilo del script (los hilos de fondo no llaman st.*)
+    with estado["lock"]:
+        estado["ids"] = None
+        try:
+            os.remove(CARPETAS_FILE)
+        except OSError:
+            pass
+
+
+def validar_carpetas(ids: dict, estado: dict):
+    # Corre en un hilo: cliente Drive propio (httplib2 no es thread-safe)
+    try:
+        service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+        for folder_id in ids.values():
+            meta = api.llamar(lambda: service.files().get(fileId=folder_id, fields="id, trashed").execute())
+            if meta.get("trashed"):
+                invalidar_carpetas(estado)
+                return
+    except HttpError as e:
+        if e.resp.status == 404:
+            invalidar_carpetas(estado)
+    except Exception:
+        pass  # validación "best effort": la siguiente llamada con 404 re-resuelve igual
+
+
+def resolver_carpetas() -> dict:
+    estado = estado_carpetas()
+    with estado["lock"]:
+        if estado["ids"] is None or time.time() - estado["ts"] > CARPETAS_TTL_S:
+            ids, ts = leer_cache_carpetas()
+            if not all(ids.get(k) for k in ("Bluecoins", "QuickSync", "Pictures")):
+                bluecoins = buscar_carpeta("Bluecoins")
+                ids = {
+                    "Bluecoins": bluecoins,
+                    "QuickSync": buscar_carpeta("QuickSync", parent_id=bluecoins) if bluecoins else None,
+                    "Pictures": buscar_carpeta("Pictures", parent_id=bluecoins) if bluecoins else None,
+                }
+                if not all(ids.values()):
+                    return ids  # no se cachea un resultado incompleto
+                ts = time.time()
+                guardar_cache_carpetas(ids, ts)
+                estado["validado"] = ts  # recién resueltas: no hace falta validar
+            estado["ids"], estado["ts"] = ids, ts
+        ids = dict(estado["ids"])
+
+        if time.time() - estado["validado"] > CARPETAS_VALIDACION_S:
+            estado["validado"] = time.time()
+            threading.Thread(target=validar_carpetas, args=(ids, estado), daemon=True).start()
+    return ids
+
+
+carpetas = resolver_carpetas()
+bluecoins_id = carpetas.get("Bluecoins")
+quicksync_id = carpetas.get("QuickSync")
+pictures_id = carpetas.get("Pictures")
 
 if not bluecoins_id or not quicksync_id or not pictures_id:
     st.error("No se encontraron carpetas requeridas en Drive (Bluecoins/QuickSync/Pictures).")
-    st.stop()
+    detener()
 
 
-def descargar_archivo_boleta(file_name: str) -> str | None:
-    q = f"'{pictures_id}' in parents and trashed = false and name = '{file_name}'"
-    results = drive_service.files().list(q=q, fields="files(id, name)").execute()
-    files = results.get("files", [])
-    if not files:
+# --- Índice de Bluecoins/Pictures: nombre → (fileId, md5, size, modifiedTime) ---
+class IndicePictures:
+    CAMPOS = "id, name, md5Checksum, size, modifiedTime"
+
+    def __init__(self, pictures_id: str):
+        self.pictures_id = pictures_id
+        self.lock = threading.Lock()
+        self.por_nombre: dict[str, dict] = {}
+        self.nombre_por_id: dict[str, str] = {}
+        self.page_token = None
+        self.cargado = 0.0
+        self.refrescado = 0.0
+
+    def _agregar(self, f: dict):
+        nombre = f.get("name")
+        if not nombre:
+            return
+        self._quitar(f["id"])  # pudo cambiar de nombre
+        actual = self.por_nombre.get(nombre)
+        # nombres duplicados: gana la versión más reciente
+        if actual is None or f.get("modifiedTime", "") >= actual.get("modifiedTime", ""):
+            self.por_nombre[nombre] = f
+        self.nombre_por_id[f["id"]] = nombre
+
+    def _quitar(self, file_id: str):
+        nombre = self.nombre_por_id.pop(file_id, None)
+        if nombre and self.por_nombre.get(nombre, {}).get("id") == file_id:
+            del self.por_nombre[nombre]
+
+    def _cargar_completo(self, service):
+        # El token se pide ANTES de listar: ningún cambio queda fuera
+        token = api.llamar(lambda: service.changes().getStartPageToken().execute())["startPageToken"]
+        self.por_nombre, self.nombre_por_id = {}, {}
+        page = None
+        while True:
+            res = api.llamar(
+                lambda: service.files().list(
+                    q=f"'{self.pictures_id}' in parents and trashed = false",
+                    fields=f"nextPageToken, files({self.CAMPOS})",
+                    pageSize=1000,
+                    pageToken=page,
+                ).execute()
+            )
+            for f in res.get("files", []):
+                self._agregar(f)
+            page = res.get("nextPageToken")
+            if not page:
+                break
+        self.page_token = token
+        self.cargado = self.refrescado = time.time()
+
+    def _aplicar_cambios(self, service):
+        page = self.page_token
+        while page:
+            res = api.llamar(
+                lambda: service.changes().list(
+                    pageToken=page,
+                    fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({self.CAMPOS}, parents, trashed))",
+                    pageSize=1000,
+                ).execute()
+            )
+            for ch in res.get("changes", []):
+                f = ch.get("file") or {}
+                if ch.get("removed") or f.get("trashed") or self.pictures_id not in f.get("parents", []):
+                    self._quitar(ch["fileId"])
+                else:
+                    self._agregar(f)
+            if "newStartPageToken" in res:
+                self.page_token = res["newStartPageToken"]
+            page = res.get("nextPageToken")
+        self.refrescado = time.time()
+
+    def refrescar(self, service, forzar: bool = False):
+        ahora = time.time()
+        if self.page_token is None or ahora - self.cargado > PICTURES_RECARGA_S:
+            self._cargar_completo(service)
+        elif forzar or ahora - self.refrescado > PICTURES_REFRESCO_S:
+            self._aplicar_cambios(service)
+
+    def buscar(self, file_name: str, service) -> dict | None:
+        with self.lock:
+            self.refrescar(service)
+            meta = self.por_nombre.get(file_name)
+            if meta is None and time.time() - self.refrescado > 5:
+                # Boleta recién subida: un refresco incremental extra antes de rendirse
+                self.refrescar(service, forzar=True)
+                meta = self.por_nombre.get(file_name)
+            return meta
+
+
+@st.cache_resource
+def indice_pictures(pictures_id: str) -> IndicePictures:
+    return IndicePictures(pictures_id)
+
+
+# --- Caché en disco acotada (LRU por mtime = último uso) ---
+class CacheDisco:
+    def __init__(self, directorio: str, max_bytes: int):
+        self.dir = directorio
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expulsiones = 0
+        os.makedirs(directorio, exist_ok=True)
+        self.bytes_totales = sum(
+            os.path.getsize(os.path.join(directorio, n)) for n in os.listdir(directorio) if not n.endswith(".part")
+        )
+
+    def ruta(self, clave: str) -> str:
+        return os.path.join(self.dir, re.sub(r"[^A-Za-z0-9_.-]", "_", clave))
+
+    def obtener(self, clave: str) -> str | None:
+        ruta = self.ruta(clave)
+        try:
+            os.utime(ruta)  # marca de uso reciente para el LRU
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return ruta
+
+    def guardar(self, clave: str, escribir) -> str:
+        """escribir(fh) vuelca el contenido; se publica con renombrado atómico."""
+        ruta = self.ruta(clave)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                escribir(fh)
+            tam = os.path.getsize(tmp)
+            with self.lock:
+                previo = os.path.getsize(ruta) if os.path.exists(ruta) else 0
+                os.replace(tmp, ruta)
+                self.bytes_totales += tam - previo
+                self._expulsar(protegida=ruta)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return ruta
+
+    def _expulsar(self, protegida: str):
+        if self.bytes_totales <= self.max_bytes:
+            return
+        entradas = []
+        for n in os.listdir(self.dir):
+            if n.endswith(".part"):
+                continue
+            p = os.path.join(self.dir, n)
+            try:
+                st_ = os.stat(p)
+            except FileNotFoundError:
+                continue
+            entradas.append((st_.st_mtime, st_.st_size, p))
+        entradas.sort()  # menos usados primero
+        total = sum(e[1] for e in entradas)
+        ahora = time.time()
+        for mtime, tam, p in entradas:
+            if total <= self.max_bytes:
+                break
+            if p == protegida or ahora - mtime < CACHE_GRACIA_S:
+                continue
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= tam
+            self.expulsiones += 1
+        self.bytes_totales = total
+
+    def estadisticas(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expulsiones": self.expulsiones,
+                "MB": round(self.bytes_totales / 1e6, 1),
+                "max_MB": round(self.max_bytes / 1e6, 1),
+            }
+
+
+@st.cache_resource
+def cache_boletas() -> CacheDisco:
+    return CacheDisco(BOLETAS_DIR, BOLETAS_CACHE_MAX_MB * 1_000_000)
+
+
+@st.cache_resource
+def pool_descargas() -> tuple[ThreadPoolExecutor, threading.local]:
+    # httplib2 no es thread-safe: cada hilo del pool crea su propio cliente Drive
+    local = threading.local()
+
+    def init_hilo():
+        local.service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+
+    pool = ThreadPoolExecutor(max_workers=BOLETAS_WORKERS, thread_name_prefix="boletas", initializer=init_hilo)
+    return pool, local
+
+
+@st.cache_resource
+def cache_derivados() -> CacheDisco:
+    return CacheDisco(DERIVADOS_DIR, DERIVADOS_CACHE_MAX_MB * 1_000_000)
+
+
+# Recursos compartidos resueltos en el hilo del script (los hilos del pool no tocan st.*);
+# indice_pics se crea después de listar el .fydb, cuando pictures_id ya quedó re-resuelto
+carpetas_estado = estado_carpetas()
+boletas_cache = cache_boletas()
+derivados_cache = cache_derivados()
+
+
+def descargar_archivo_boleta(file_name: str, service=None) -> str | None:
+    service = service or drive_service
+    try:
+        meta = indice_pics.buscar(file_name, service)
+    except HttpError as e:
+        if e.resp.status == 404:
+            invalidar_carpetas(carpetas_estado)  # Pictures cambió: se re-resuelve en el próximo rerun
+            return None
+        raise
+    if not meta:
         return None
-    file_id = files[0]["id"]
-    request = drive_service.files().get_media(fileId=file_id)
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix="." + file_name.split(".")[-1])
-    with open(tmp.name, "wb") as fh:
+
+    # Clave por contenido: fileId + md5 (modifiedTime si Drive no entrega md5)
+    ext = os.path.splitext(file_name)[-1].lower()
+    clave = f"{meta['id']}_{meta.get('md5Checksum') or meta.get('modifiedTime', '')}{ext}"
+    ruta = boletas_cache.obtener(clave)
+    if ruta:
+        return ruta
+
+    def escribir(fh):
+        request = service.files().get_media(fileId=meta["id"])
         downloader = MediaIoBaseDownload(fh, request)
         done = False
         while not done:
             _, done = downloader.next_chunk()
-    return tmp.name
 
+    # Dos sesiones pidiendo la misma boleta comparten una sola descarga; un reintento reescribe desde cero
+    return api.llamar(lambda: boletas_cache.guardar(clave, escribir), clave=("get_media", clave))
+
+
+# --- Derivados de imagen: tamaño de pantalla, orientación EXIF, WebP ---
+def generar_vista_imagen(ruta: str) -> str:
+    # La ruta de la boleta ya lleva fileId + md5 → el derivado queda ligado al contenido
+    base = os.path.splitext(os.path.basename(ruta))[0]
+    clave = f"{base}_w{ANCHO_BOLETA}.webp"
+    ruta_vista = derivados_cache.obtener(clave)
+    if ruta_vista:
+        return ruta_vista
+
+    def escribir(fh):
+        with Image.open(ruta) as original:
+            # JPEG: decodifica directo a 1/2, 1/4 o 1/8 de escala (nunca bajo el tamaño pedido)
+            original.draft("RGB", (ANCHO_BOLETA, ANCHO_BOLETA))
+            imagen = ImageOps.exif_transpose(original)
+            if imagen.width > imagen.height:
+                imagen = imagen.rotate(90, expand=True)
+            imagen.thumbnail((ANCHO_BOLETA, ANCHO_BOLETA * 4))
+            if imagen.mode not in ("RGB", "RGBA"):
+                imagen = imagen.convert("RGBA" if "A" in imagen.getbands() else "RGB")
+            imagen.save(fh, format="WEBP", quality=80, method=4)
+
+    return derivados_cache.guardar(clave, escribir)
+
+
+@st.cache_resource
+def lock_pdfium() -> threading.Lock:
+    # pdfium no es thread-safe: se serializa su uso entre hilos
+    return threading.Lock()
 
-def mostrar_boleta_desde_ruta(ruta: str, key_suffix: str):
+
+_lock_pdfium = lock_pdfium()
+
+
+def generar_vistas_pdf(ruta: str, paginas: int = PDF_PAGINAS_VISTA) -> list[str]:
+    """Rasteriza (una vez) las primeras páginas del PDF a WebP cacheado."""
+    if pdfium is None:
+        return []
+    base = os.path.splitext(os.path.basename(ruta))[0]
+    rutas = []
+    pdf = None
+    try:
+        for n in range(paginas):
+            clave = f"{base}_p{n + 1}_w{ANCHO_BOLETA}.webp"
+            ruta_vista = derivados_cache.obtener(clave)
+            if ruta_vista:
+                rutas.append(ruta_vista)
+                continue
+            with _lock_pdfium:
+                if pdf is None:
+                    pdf = pdfium.PdfDocument(ruta)
+                if n >= len(pdf):
+                    break
+                pagina = pdf[n]
+                imagen = pagina.render(scale=ANCHO_BOLETA / pagina.get_width()).to_pil()
+                pagina.close()
+            rutas.append(derivados_cache.guardar(clave, lambda fh, im=imagen: im.save(fh, format="WEBP", quality=80)))
+    finally:
+        if pdf is not None:
+            with _lock_pdfium:
+                pdf.close()
+    return rutas
+
+
+def preparar_boleta(file_name: str, service=None) -> dict | None:
+    """Descarga la boleta y genera sus vistas livianas. Pensada para correr en el pool."""
+    ruta = descargar_archivo_boleta(file_name, service)
+    if not ruta:
+        return None
+    ext = os.path.splitext(ruta)[-1].lower()
+    vistas = []
+    try:
+        if ext in [".jpg", ".jpeg", ".png"]:
+            vistas = [generar_vista_imagen(ruta)]
+        elif ext == ".pdf":
+            vistas = generar_vistas_pdf(ruta)
+    except Exception:
+        vistas = []  # archivo raro: se muestra como antes / sólo descarga
+    return {"nombre": file_name, "ruta": ruta, "vistas": vistas}
+
+
+def prefetch_boletas(archivos: list[str]) -> dict[str, Future]:
+    """Encola en el pool la descarga de las boletas indicadas (sin repetir)."""
+    pool, local = pool_descargas()
+    futuros = {}
+    for file_name in archivos:
+        if file_name not in futuros:
+            # copy_context: las llamadas del hilo cuentan contra el presupuesto de este rerun
+            futuros[file_name] = pool.submit(
+                contextvars.copy_context().run, lambda fn=file_name: preparar_boleta(fn, local.service)
+            )
+    return futuros
+
+
+def mostrar_imagen_original(ruta: str):
+    imagen = ImageOps.exif_transpose(Image.open(ruta))
+    if imagen.width > imagen.height:
+        imagen = imagen.rotate(90, expand=True)
+    st.image(imagen, caption="Boleta (resolución completa)")
+
+
+def mostrar_boleta_desde_ruta(ruta: str, key_suffix: str, vistas: list[str] | None = None, nombre: str | None = None):
     ext = os.path.splitext(ruta)[-1].lower()
     if ext in [".jpg", ".jpeg", ".png"]:
-        imagen = Image.open(ruta)
-        if imagen.width > imagen.height:
-            imagen = imagen.rotate(90, expand=True)
-        st.image(imagen, caption="Boleta")
+        if not vistas:
+            mostrar_imagen_original(ruta)
+            return
+        st.image(vistas[0], caption="Boleta")
+        # La resolución completa sólo se decodifica si se pide
+        if st.checkbox("Ver en resolución completa", key=f"full_{key_suffix}"):
+            mostrar_imagen_original(ruta)
     elif ext == ".pdf":
-        with open(ruta, "rb") as f:
-            base64_pdf = base64.b64encode(f.read()).decode("utf-8")
-        pdf_display = f"""
-            <iframe src="data:application/pdf;base64,{base64_pdf}"
-                    width="700" height="900" type="application/pdf"></iframe>
-        """
-        st.components.v1.html(pdf_display, height=920)
-        with open(ruta, "rb") as f:
-            st.download_button(
-                label="Descargar boleta PDF",
-                data=f,
-                file_name=os.path.basename(ruta),
-                mime="application/pdf",
-                key=f"dlpdf_{key_suffix}",
-            )
+        for n, vista in enumerate(vistas or []):
+            st.image(vista, caption=f"Boleta PDF (página {n + 1})")
+        if not vistas:
+            st.info("Vista previa del PDF no disponible; puedes descargarlo.")
+        # El original sólo viaja al navegador si se pide
+        if st.checkbox("Ver PDF completo / descargar", key=f"pdf_{key_suffix}"):
+            for n, vista in enumerate(generar_vistas_pdf(ruta, PDF_PAGINAS_MAX)[len(vistas or []):]):
+                st.image(vista, caption=f"Boleta PDF (página {n + 1 + len(vistas or [])})")
+            with open(ruta, "rb") as f:
+                st.download_button(
+                    label="Descargar boleta PDF",
+                    data=f,
+                    file_name=nombre or os.path.basename(ruta),
+                    mime="application/pdf",
+                    key=f"dlpdf_{key_suffix}",
+                )
 
 
 # -------------------------
-# Descargar .fydb más reciente
+# Descargar .fydb más reciente (caché por versión)
 # -------------------------
-q = f"'{quicksync_id}' in parents and trashed = false and name contains '.fydb'"
-results = drive_service.files().list(q=q, fields="files(id, name, modifiedTime)").execute()
-fydb_files = results.get("files", [])
+def version_snapshot(meta: dict) -> str:
+    # fileId + md5Checksum identifican el contenido; modifiedTime como respaldo
+    return f"{meta['id']}_{meta.get('md5Checksum') or meta['modifiedTime']}"
+
+
+def ruta_snapshot(version: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", version) + ".fydb")
+
+
+@st.cache_resource
+def lock_snapshots() -> threading.Lock:
+    # Evita que dos sesiones descarguen la misma versión a la vez
+    return threading.Lock()
+
+
+# Una conexión de sólo lectura por snapshot, compartida por todas las sesiones.
+# immutable=1: SQLite no bloquea ni revisa cambios (el archivo de una versión nunca se modifica);
+# con mmap las páginas salen directo del page cache del sistema.
+@st.cache_resource
+def conexiones_snapshot() -> dict:
+    # ruta -> (conn, lock de la conexión, en memoria?); las en memoria no tienen archivo en disco
+    return {"lock": threading.Lock(), "conns": {}}
+
+
+def conexion_snapshot(ruta_fydb: str) -> tuple[sqlite3.Connection, threading.Lock]:
+    estado = conexiones_snapshot()
+    with estado["lock"]:
+        if ruta_fydb not in estado["conns"]:
+            conn = sqlite3.connect(f"file:{ruta_fydb}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {SNAPSHOT_MMAP_BYTES}")
+            estado["conns"][ruta_fydb] = (conn, threading.Lock(), False)
+        return estado["conns"][ruta_fydb][:2]
+
+
+# deserialize: Python 3.11+ compilado con la API de serialización de SQLite; si no, siempre a disco
+DESERIALIZE_DISPONIBLE = hasattr(sqlite3.Connection, "deserialize")
+
+
+def registrar_snapshot_en_memoria(ruta_fydb: str, contenido) -> bool:
+    """Carga la imagen con deserialize; False si SQLite no puede leerla (el llamador usa disco)."""
+    # Bytes 18/19 = 2: cabecera en modo WAL (frecuente en bases Android). Una imagen en memoria
+    # no tiene -wal asociado y SQLite no la abre; se marca como rollback journal (1), que es
+    # equivalente para un snapshot de sólo lectura.
+    if len(contenido) > 19 and contenido[18] == 2 and contenido[19] == 2:
+        contenido[18] = contenido[19] = 1
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        conn.deserialize(contenido)
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    except sqlite3.Error:
+        conn.close()
+        return False
+    estado = conexiones_snapshot()
+    with estado["lock"]:
+        estado["conns"][ruta_fydb] = (conn, threading.Lock(), True)
+    return True
+
+
+def snapshot_en_memoria(ruta_fydb: str) -> bool:
+    estado = conexiones_snapshot()
+    with estado["lock"]:
+        return estado["conns"].get(ruta_fydb, (None, None, False))[2]
+
+
+def cerrar_conexion_snapshot(ruta_fydb: str):
+    estado = conexiones_snapshot()
+    with estado["lock"]:
+        conn, lock, _ = estado["conns"].pop(ruta_fydb, (None, None, False))
+    if conn is not None:
+        with lock:  # espera a que termine una lectura en curso
+            conn.close()
+
+
+def retirar_snapshots_antiguos(ruta_vigente: str):
+    existentes = [
+        os.path.join(SNAPSHOT_DIR, n) for n in os.listdir(SNAPSHOT_DIR) if n.endswith(".fydb")
+    ]
+    existentes.sort(key=os.path.getmtime, reverse=True)
+    antiguos = [p for p in existentes if p != ruta_vigente][SNAPSHOTS_A_CONSERVAR - 1:]
+    estado = conexiones_snapshot()
+    with estado["lock"]:
+        en_memoria = [r for r, (_, _, mem) in estado["conns"].items() if mem and r != ruta_vigente]
+    # Snapshots en memoria: se conservan los más recientes (orden de registro), igual que en disco
+    for r in en_memoria[: max(0, len(en_memoria) - (SNAPSHOTS_A_CONSERVAR - 1))]:
+        cerrar_conexion_snapshot(r)
+    for p in antiguos:
+        cerrar_conexion_snapshot(p)
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def _descargar_en(fh, request):
+    def descargar():
+        fh.seek(0)
+        fh.truncate()
+        downloader = MediaIoBaseDownload(fh, request, chunksize=SNAPSHOT_CHUNK_MB * 1024 * 1024)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+
+    api.llamar(descargar)
+
+
+def obtener_snapshot(meta: dict) -> tuple[str, bool]:
+    """Devuelve (ruta local, descargado?) reutilizando la copia si Drive no reporta cambios.
+
+    Snapshots pequeños quedan sólo en memoria: la "ruta" es entonces la clave de su conexión.
+    """
+    ruta = ruta_snapshot(version_snapshot(meta))
+    if snapshot_en_memoria(ruta) or os.path.exists(ruta):
+        return ruta, False
+
+    with lock_snapshots():
+        if snapshot_en_memoria(ruta) or os.path.exists(ruta):  # otra sesión la descargó mientras esperábamos
+            return ruta, False
+
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        request = drive_service.files().get_media(fileId=meta["id"])
+        tamano = int(meta.get("size") or 0)
+        buffer = None
+        if DESERIALIZE_DISPONIBLE and 0 < tamano <= SNAPSHOT_MEMORIA_MAX_MB * 1024 * 1024:
+            buffer = io.BytesIO()
+            _descargar_en(buffer, request)
+            with buffer.getbuffer() as vista:  # sin copiar a bytes: SQLite hace su propia copia
+                en_memoria = registrar_snapshot_en_memoria(ruta, vista)
+            if en_memoria:
+                buffer.close()
+                retirar_snapshots_antiguos(ruta)
+                return ruta, True
+            # Imagen que deserialize no lee: se guarda lo ya descargado y se abre desde disco
+
+        # Sin tamaño conocido, sobre el límite o ilegible en memoria: a disco
+        fd, tmp = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                if buffer is not None:
+                    fh.write(buffer.getbuffer())
+                    buffer.close()
+                else:
+                    _descargar_en(fh, request)
+            # Renombrado atómico: nadie ve un .fydb a medio escribir
+            os.replace(tmp, ruta)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        retirar_snapshots_antiguos(ruta)
+    return ruta, True
+
+
+def listar_fydb(quicksync_id: str) -> list[dict]:
+    q = f"'{quicksync_id}' in parents and trashed = false and name contains '.fydb'"
+    results = api.llamar(
+        lambda: drive_service.files().list(q=q, fields="files(id, name, modifiedTime, md5Checksum, size)").execute(),
+        clave=("files.list", q),
+    )
+    return results.get("files", [])
+
+
+try:
+    fydb_files = listar_fydb(quicksync_id)
+except HttpError as e:
+    if e.resp.status != 404:
+        raise
+    fydb_files = []
+
+if not fydb_files:
+    # IDs cacheados posiblemente obsoletos (carpeta movida/borrada): re-resolver una vez
+    invalidar_carpetas(estado_carpetas())
+    carpetas = resolver_carpetas()
+    quicksync_id = carpetas.get("QuickSync")
+    pictures_id = carpetas.get("Pictures")
+    fydb_files = listar_fydb(quicksync_id) if quicksync_id and pictures_id else []
+
 if not fydb_files:
     st.error("No se encontraron archivos .fydb en la carpeta QuickSync.")
-    st.stop()
+    detener()
 
-fydb_files.sort(key=lambda x: x["modifiedTime"], reverse=True)
+# Después de una posible re-resolución: las boletas se buscan en la carpeta Pictures vigente
+indice_pics = indice_pictures(pictures_id)
+
+fydb_files = sorted(fydb_files, key=lambda x: x["modifiedTime"], reverse=True)
 latest_file = fydb_files[0]
 
-request = drive_service.files().get_media(fileId=latest_file["id"])
-with open("bluecoins.fydb", "wb") as fh:
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        _, done = downloader.next_chunk()
+snapshot_version = version_snapshot(latest_file)
+ruta_fydb, descargado = obtener_snapshot(latest_file)
 
 fecha_modif = latest_file["modifiedTime"]
 st.info(
-    f"Archivo descargado: {latest_file['name']} "
+    f"{'Archivo descargado' if descargado else 'Usando copia local'}: {latest_file['name']} "
     f"(última modificación: {fecha_modif.replace('T', ' ').replace('Z', '')})"
 )
+dbg("Snapshot", {
+    "version": snapshot_version, "ruta": ruta_fydb, "descargado": descargado,
+    "en_memoria": snapshot_en_memoria(ruta_fydb),
+})
 
 
 # -------------------------
 # Lectura de tablas SQLite
 # -------------------------
-@st.cache_data
-def leer_tabla(nombre_tabla: str) -> pd.DataFrame:
-    with sqlite3.connect("bluecoins.fydb") as conn:
-        return pd.read_sql_query(f"SELECT * FROM {nombre_tabla}", conn)
+# Sólo las columnas que usa la app, con tipos compactos. Tipos: "id" (Int64), "categoria",
+# "fecha" (formato Bluecoins) y "texto" (tal cual). Columnas ausentes en la base se omiten.
+ESQUEMAS_TABLAS = {
+    "TRANSACTIONSTABLE": {
+        "transactionsTableID": "id",
+        "date": "fecha",
+        "notes": "texto",
+        "itemID": "categoria",
+        "NewSplitTransactionID": "id",
+    },
+    "ITEMTABLE": {"itemTableID": "id", "itemName": "texto"},
+    "PICTURETABLE": {"transactionID": "id", "pictureFileName": "texto"},
+}
+
+
+def _tipar_lote(df: pd.DataFrame, esquema: dict) -> pd.DataFrame:
+    for col, tipo in esquema.items():
+        if col not in df.columns:
+            continue
+        if tipo == "id":
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        elif tipo == "fecha":
+            df[col] = parse_bluecoins_datetime(df[col])
+    return df
+
+
+def leer_tabla(nombre_tabla: str, ruta_fydb: str, reporte: dict | None = None) -> pd.DataFrame:
+    """Lee una tabla del .fydb proyectando y tipando según ESQUEMAS_TABLAS, en lotes.
+
+    reporte (opcional) recibe {tabla: {filas, columnas_omitidas, bytes_leidos, bytes_tipados}}.
+    """
+    esquema = ESQUEMAS_TABLAS.get(nombre_tabla)
+    conn, lock = conexion_snapshot(ruta_fydb)
+    with lock:
+        if esquema is None:
+            return pd.read_sql_query(f"SELECT * FROM {nombre_tabla}", conn)
+        existentes = [r[1] for r in conn.execute(f"PRAGMA table_info({nombre_tabla})")]
+        cols = [c for c in esquema if c in existentes]
+        if not cols:
+            raise ValueError(f"{nombre_tabla}: ninguna de las columnas esperadas existe")
+        lotes = []
+        bytes_leidos = 0
+        consulta = f"SELECT {', '.join(cols)} FROM {nombre_tabla}"
+        for lote in pd.read_sql_query(consulta, conn, chunksize=LECTURA_CHUNK_FILAS):
+            bytes_leidos += int(lote.memory_usage(deep=True).sum())
+            lotes.append(_tipar_lote(lote, esquema))
+
+    df = pd.concat(lotes, ignore_index=True) if lotes else pd.DataFrame(columns=cols)
+    if not lotes:
+        df = _tipar_lote(df, esquema)
+    # Categóricas después de juntar: lotes con categorías distintas no se concatenan como categoría
+    for col, tipo in esquema.items():
+        if tipo == "categoria" and col in df.columns:
+            df[col] = df[col].astype("Int64").astype("category")
+    if reporte is not None:
+        reporte[nombre_tabla] = {
+            "filas": len(df),
+            "columnas_omitidas": len(existentes) - len(cols),
+            "bytes_leidos": bytes_leidos,
+            "bytes_tipados": int(df.memory_usage(deep=True).sum()),
+        }
+    return df
 
 
-df_trans = leer_tabla("TRANSACTIONSTABLE")
-df_trans["date"] = parse_bluecoins_datetime(df_trans["date"])
-df_trans = df_trans[df_trans["date"] <= pd.Timestamp(datetime.now().date())].copy()
+# -------------------------
+# Componentes conexos (closure de split/hermanas) sobre arreglos
+# -------------------------
+def componentes_conexos(padre: np.ndarray, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """Union-find vectorizado (hooking + pointer jumping); la raíz es el menor índice del componente."""
+    padre = padre.copy()
+    while True:
+        while True:
+            abuelo = padre[padre]
+            if np.array_equal(abuelo, padre):
+                break
+            padre = abuelo
+        ru, rv = padre[u], padre[v]
+        distintos = ru != rv
+        if not distintos.any():
+            return padre
+        ru, rv = ru[distintos], rv[distintos]
+        np.minimum.at(padre, np.maximum(ru, rv), np.minimum(ru, rv))
+
+
+@st.cache_resource
+def estado_componentes() -> dict:
+    # Último cálculo: permite actualizar sólo con las aristas nuevas del snapshot siguiente
+    return {"lock": threading.Lock(), "nodos": None, "aristas": None, "etiquetas": None}
+
+
+def calcular_componentes(tids: pd.Series, splits: pd.Series, pic_ids) -> tuple[pd.Series, bool]:
+    """Devuelve (id → comp_id, incremental?). Nodos: tids, splits y transacciones con boleta."""
+    con_split = splits != ""
+    aristas = pd.Index(tids[con_split] + "\x00" + splits[con_split])
+    nodos = pd.unique(
+        np.concatenate([
+            tids.to_numpy(dtype=object),
+            splits[con_split].to_numpy(dtype=object),
+            np.asarray(list(pic_ids), dtype=object),
+        ])
+    )
+
+    estado = estado_componentes()
+    with estado["lock"]:
+        previas = estado["aristas"]
+        # Sólo llegaron transacciones/aristas nuevas → se parte del bosque anterior
+        incremental = previas is not None and bool(previas.isin(aristas).all())
+        if incremental:
+            ids = estado["nodos"].append(pd.Index(nodos).difference(estado["nodos"], sort=False))
+            padre = np.concatenate([estado["etiquetas"], np.arange(len(estado["nodos"]), len(ids))])
+            nuevas = ~aristas.isin(previas)
+        else:
+            ids = pd.Index(nodos)
+            padre = np.arange(len(ids))
+            nuevas = np.ones(len(aristas), dtype=bool)
 
-df_item = leer_tabla("ITEMTABLE")  # solo para "comercio" al guardar
-df_pic = leer_tabla("PICTURETABLE")
+        u = ids.get_indexer(tids[con_split].to_numpy()[nuevas])
+        v = ids.get_indexer(splits[con_split].to_numpy()[nuevas])
+        etiquetas = componentes_conexos(padre, u, v)
+        estado.update(nodos=ids, aristas=aristas, etiquetas=etiquetas)
+
+    return pd.Series(ids[etiquetas].to_numpy(), index=ids), incremental
 
 
 # -------------------------
-# UI búsqueda
+# Boletas por componente (ordenadas por fecha)
 # -------------------------
-nombre_producto = st.text_input("Producto a buscar:")
-solo_con_boleta = st.radio("¿Mostrar sólo registros con boleta?", options=["Sí", "No"], index=0)
-n_resultados = st.number_input("¿Cuántas compras quieres ver? (máximo)", min_value=1, max_value=50, value=3)
+def boletas_por_comp(df_pic_in: pd.DataFrame, df_trans_in: pd.DataFrame, comp_de: pd.Series) -> pd.DataFrame:
+    if df_pic_in.empty or "transactionID" not in df_pic_in.columns or "pictureFileName" not in df_pic_in.columns:
+        return pd.DataFrame(columns=["comp_id", "pictureFileName", "_fecha", "tid_str"])
 
-if not nombre_producto:
-    st.info("Ingresa un producto para comenzar.")
-    st.stop()
+    aux = df_pic_in[["transactionID", "pictureFileName"]].copy()
+    aux["tid_str"] = aux["transactionID"].astype(str)
 
-# Estado descartados (por componente)
-if "descartados_comp" not in st.session_state:
-    st.session_state.descartados_comp = set()
+    aux = aux.merge(df_trans_in[["tid_str", "date"]], on="tid_str", how="left")
+    aux["_fecha"] = pd.to_datetime(aux["date"], errors="coerce")
+    aux = aux.dropna(subset=["pictureFileName"])
+    aux["comp_id"] = aux["tid_str"].map(comp_de)
 
-nombre_normalizado = normalizar(nombre_producto)
+    aux = aux.sort_values("_fecha", ascending=False)
+    return aux
 
-# Historial en memoria
-df_hist, row_by_key = cargar_historial(worksheet)
 
-# --- RESUMEN EN CABECERA (CORREGIDO) ---
-hist_prod = df_hist[df_hist["prod_norm"] == nombre_normalizado].copy()
+# -------------------------
+# Índice FTS5 (trigramas) sobre el texto de búsqueda
+# -------------------------
+def ruta_indice_fts(snapshot_version: str, hoy: str) -> str:
+    return os.path.join(INDICES_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", f"{snapshot_version}_{hoy}") + ".sqlite")
+
+
+def construir_indice_fts(ruta_indice: str, textos: pd.Series):
+    """Base SQLite derivada: rowid = posición de la fila en df_trans."""
+    if os.path.exists(ruta_indice):
+        return
+    os.makedirs(INDICES_DIR, exist_ok=True)
+    tmp = ruta_indice + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        with conn:
+            conn.execute("CREATE VIRTUAL TABLE textos USING fts5(texto, tokenize='trigram')")
+            conn.executemany("INSERT INTO textos(rowid, texto) VALUES (?, ?)", enumerate(textos.tolist()))
+    finally:
+        conn.close()
+    os.replace(tmp, ruta_indice)
+
+    # Retirar índices de snapshots/días anteriores (se conserva el previo para sesiones en curso)
+    existentes = [os.path.join(INDICES_DIR, n) for n in os.listdir(INDICES_DIR) if n.endswith(".sqlite")]
+    existentes.sort(key=os.path.getmtime, reverse=True)
+    for p in existentes[SNAPSHOTS_A_CONSERVAR:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def buscar_en_indice(ruta_indice: str, texto_norm: str) -> list[int] | None:
+    """Posiciones cuyo texto contiene texto_norm; None si el índice no aplica (< 3 caracteres)."""
+    if len(texto_norm) < 3:
+        return None  # el tokenizador trigram no indexa subcadenas más cortas
+    frase = '"' + texto_norm.replace('"', '""') + '"'
+    with sqlite3.connect(f"file:{ruta_indice}?mode=ro", uri=True) as conn:
+        return [r[0] for r in conn.execute("SELECT rowid FROM textos WHERE textos MATCH ? ORDER BY rowid", (frase,))]
 
-if not hist_prod.empty:
-    # 1. Determinamos la unidad más frecuente para este producto en el historial
-    u_counts = hist_prod["Unidad"].astype(str).str.strip()
-    u_counts = u_counts[u_counts != ""]
-    
-    if not u_counts.empty:
-        unidad_para_resumen = u_counts.value_counts().idxmax()
-        
-        # 2. Calculamos el resumen usando esa unidad
-        res = calcular_resumen(hist_prod, unidad_para_resumen)
-        
-        if res:
-# NUEVO: consumo mensual sin la última compra
-# 1. Filtrar historial por unidad usada
-            df_filtrado = hist_prod[hist_prod["Unidad"].astype(str).str.strip() == unidad_para_resumen].copy()
-            df_filtrado["Cantidad_f"] = df_filtrado["Cantidad"].apply(to_float)
-            df_filtrado["Fecha_dt"] = pd.to_datetime(df_filtrado["Fecha"], errors="coerce")
-            df_filtrado = df_filtrado.dropna(subset=["Cantidad_f", "Fecha_dt"])
-            df_filtrado = df_filtrado[(df_filtrado["Cantidad_f"] > 0)]
-
-# 2. Ordenar y separar última compra
-            df_ordenado = df_filtrado.sort_values("Fecha_dt")
-            df_consumo = df_ordenado.iloc[:-1] if len(df_ordenado) > 1 else pd.DataFrame()
-
-# 3. Cálculo de unidades consumidas y consumo mensual promedio
-            unidades_consumidas = df_consumo["Cantidad_f"].sum() if not df_consumo.empty else 0.0
-# Mostrar unidades consumidas y rango completo (incluye fecha de la última compra)
-            if not df_consumo.empty:
-                f_ini = df_consumo["Fecha_dt"].min()
-                f_fin = df_ordenado["Fecha_dt"].max() # ← mantiene el rango completo
-                dias = max(1, (f_fin - f_ini).days)
-                consumo_mensual_ajustado = unidades_consumidas / (dias / 30)
-            else:
-                f_ini = f_fin = pd.NaT
-                consumo_mensual_ajustado = 0.0
-
-# 4. Mostrar panel visual
-            st.markdown(f"<div style='background-color:#e6f4ea; padding:0.6em; border-radius:0.5em;'>"
-            f"<b>📊 Resumen Histórico Global ({res['unidad']})</b></div>",
-            unsafe_allow_html=True)
-
-            col1, col2 = st.columns(2)
-            with col1:
-                st.markdown(
-                    f"""<div>
-                    <b>Rango:</b> {res['periodo_ini'].strftime('%d/%m/%y')} al {res['periodo_fin'].strftime('%d/%m/%y')}<br>
-                    <b>Unidades consumidas:</b> {unidades_consumidas:.2f}
-                    </div>""",
-                    unsafe_allow_html=True
-                )
 
-            with col2:
-                st.markdown(
-                    f"""<div>
-                    <b>Precio Unitario:</b><br>
-                    <span style='margin-left: 10px;'>Min: <span style='color: green; font-family: monospace;'>{formatear_pesos(res['precio_min'])}</span></span><br>
-                    <span style='margin-left: 10px;'>Máx: <span style='color: red; font-family: monospace;'>{formatear_pesos(res['precio_max'])}</span></span><br>
-                    <span style='margin-left: 10px;'>Prom. Ponderado: <span style='color: blue; font-family: monospace;'>{formatear_pesos(res['precio_prom'])}</span></span>
-                    </div>""",
-                    unsafe_allow_html=True
-                )
+# -------------------------
+# Fuzzy con poda por bigramas (fallback sin coincidencia exacta)
+# -------------------------
+class IndiceFuzzy:
+    """Índice invertido de bigramas sobre las notas únicas de un snapshot.
+
+    Poda segura para partial_ratio >= 80: si alguna ventana del texto alcanza ese
+    puntaje, comparte al menos 0.3·len(consulta) - 1 bigramas con la consulta.
+    Las notas más cortas que la consulta (roles invertidos) nunca se podan.
+    """
+
+    UMBRAL = 80
+
+    def __init__(self, notas: list[str]):
+        self.notas = list(notas)
+        self.largos = np.fromiter((len(n) for n in self.notas), dtype=np.int32, count=len(self.notas))
+        postings = defaultdict(list)
+        for i, nota in enumerate(self.notas):
+            for g in {nota[j:j + 2] for j in range(len(nota) - 1)}:
+                postings[g].append(i)
+        self.postings = {g: np.asarray(v, dtype=np.int32) for g, v in postings.items()}
+
+    def candidatos(self, consulta: str) -> np.ndarray:
+        m = len(consulta)
+        cuenta_q = Counter(consulta[j:j + 2] for j in range(m - 1))
+        minimo = math.ceil(0.3 * m - 1)
+        # cota sobre bigramas DISTINTOS compartidos (un bigrama repetido en la consulta cuenta varias veces)
+        requerido = math.ceil(minimo / max(cuenta_q.values())) if cuenta_q and minimo > 0 else 0
+        if requerido <= 0:
+            return np.arange(len(self.notas))
+        listas = [self.postings[g] for g in cuenta_q if g in self.postings]
+        if listas:
+            conteo = np.bincount(np.concatenate(listas), minlength=len(self.notas))
+        else:
+            conteo = np.zeros(len(self.notas), dtype=np.int64)
+        return np.nonzero((conteo >= requerido) | (self.largos < m))[0]
 
-            st.markdown(
-                f"""<div style="background-color:#eaf4fc; padding: 0.75em; border-radius: 0.5em;">
-                    💡 <b>Consumo mensual promedio:</b>
-                    <span style='font-family: monospace;'>{consumo_mensual_ajustado:.2f} {res['unidad']} / mes</span><br>
-                    <small style='color: #555;'>Última compra no incluida en el consumo</small>
-                </div>""",
-                unsafe_allow_html=True
-            )
+    def buscar(self, consulta: str) -> dict[str, int]:
+        """nota_norm → puntaje, sólo para puntajes >= UMBRAL (misma semántica que antes)."""
+        opciones = {int(i): self.notas[i] for i in self.candidatos(consulta)}
+        # partial_ratio se evalúa uno a uno en Python sobre cada candidato (score_cutoff sólo filtra
+        # después de puntuar): la ganancia viene de la poda por bigramas, no de esta llamada
+        res = process.extractBests(
+            consulta, opciones, processor=None, scorer=fuzz.partial_ratio, score_cutoff=self.UMBRAL, limit=None
+        )
+        return {nota: score for nota, score, _ in res}
 
-    else:
-        st.info("No hay unidades registradas en el historial para calcular el resumen.")
-else:
-    st.info("Aún no hay historial para este producto. Los datos aparecerán aquí una vez que guardes la primera compra.")
 
 # -------------------------
-# DSU para closure de split/hermanas
+# Datos derivados por versión de snapshot
 # -------------------------
-class DSU:
-    def __init__(self):
-        self.parent = {}
-        self.rank = {}
-
-    def add(self, x: str):
-        if x not in self.parent:
-            self.parent[x] = x
-            self.rank[x] = 0
-
-    def find(self, x: str) -> str:
-        self.add(x)
-        while self.parent[x] != x:
-            self.parent[x] = self.parent[self.parent[x]]
-            x = self.parent[x]
-        return x
-
-    def union(self, a: str, b: str):
-        ra, rb = self.find(a), self.find(b)
-        if ra == rb:
-            return
-        if self.rank[ra] < self.rank[rb]:
-            ra, rb = rb, ra
-        self.parent[rb] = ra
-        if self.rank[ra] == self.rank[rb]:
-            self.rank[ra] += 1
+# Se construyen una sola vez por (versión, día) y se comparten entre todas las
+# sesiones: un rerun no hace trabajo pandas antes de la búsqueda.
+# Los DataFrames devueltos son compartidos → tratarlos como sólo lectura.
+@st.cache_resource(max_entries=2, show_spinner="Preparando datos del snapshot...")
+def construir_datos_snapshot(snapshot_version: str, ruta_fydb: str, hoy: str) -> dict:
+    memoria = {}
+    df_trans = leer_tabla("TRANSACTIONSTABLE", ruta_fydb, memoria)
+    df_trans = df_trans[df_trans["date"] <= pd.Timestamp(hoy)].reset_index(drop=True)
+
+    df_item = leer_tabla("ITEMTABLE", ruta_fydb, memoria)
+    df_pic = leer_tabla("PICTURETABLE", ruta_fydb, memoria)
+
+    # itemID -> comercio: "comercio" al guardar y nombre en el corpus de búsqueda, como en app10.py
+    comercio_por_item = {}
+    if {"itemTableID", "itemName"}.issubset(df_item.columns):
+        aux_item = df_item.dropna(subset=["itemTableID"]).drop_duplicates(subset=["itemTableID"])
+        comercio_por_item = dict(zip(aux_item["itemTableID"], aux_item["itemName"].fillna("").astype(str)))
+    if "itemID" in df_trans.columns and comercio_por_item:
+        df_trans["itemName"] = df_trans["itemID"].map(comercio_por_item).astype(object)
+
+    df_trans["tid_str"] = df_trans["transactionsTableID"].astype(str)
+
+    if "NewSplitTransactionID" in df_trans.columns:
+        df_trans["split_str_raw"] = df_trans["NewSplitTransactionID"].astype(str)
+        df_trans.loc[df_trans["NewSplitTransactionID"].isna(), "split_str_raw"] = ""
+        df_trans["split_str_raw"] = df_trans["split_str_raw"].replace({"nan": "", "None": ""})
+    else:
+        df_trans["split_str_raw"] = ""
 
+    notas = df_trans["notes"] if "notes" in df_trans.columns else pd.Series("", index=df_trans.index)
+    df_trans["notes_norm"] = normalizar_serie(notas)
+    item_name = df_trans["itemName"].fillna("") if "itemName" in df_trans.columns else ""
+    df_trans["texto_busqueda_norm"] = normalizar_serie(notas.fillna("") + " " + item_name)
 
-df_trans = df_trans.copy()
-df_trans["tid_str"] = df_trans["transactionsTableID"].astype(str)
+    ruta_indice = ruta_indice_fts(snapshot_version, hoy)
+    construir_indice_fts(ruta_indice, df_trans["texto_busqueda_norm"])
+    notas_unicas = df_trans.loc[df_trans["notes_norm"].str.len() > 0, "notes_norm"].unique().tolist()
+    indice_fuzzy = IndiceFuzzy(notas_unicas)
 
-if "NewSplitTransactionID" in df_trans.columns:
-    df_trans["split_str_raw"] = df_trans["NewSplitTransactionID"].astype(str)
-    df_trans.loc[df_trans["NewSplitTransactionID"].isna(), "split_str_raw"] = ""
-    df_trans["split_str_raw"] = df_trans["split_str_raw"].replace({"nan": "", "None": ""})
-else:
-    df_trans["split_str_raw"] = ""
+    # IDs con boleta
+    pic_ids = set()
+    if not df_pic.empty and "transactionID" in df_pic.columns:
+        pic_ids = set(df_pic["transactionID"].dropna().astype(str).unique())
 
-df_trans["notes_norm"] = df_trans.get("notes", "").apply(normalizar)
+    comp_de, comp_incremental = calcular_componentes(df_trans["tid_str"], df_trans["split_str_raw"], pic_ids)
+    df_trans["comp_id"] = df_trans["tid_str"].map(comp_de)
 
-dsu = DSU()
-for t in df_trans["tid_str"].tolist():
-    dsu.add(t)
+    # componentes con boleta (a nivel comp_id)
+    comps_con_boleta = set(comp_de.loc[list(pic_ids)]) if pic_ids else set()
 
-for t, s in zip(df_trans["tid_str"].tolist(), df_trans["split_str_raw"].tolist()):
-    if s:
-        dsu.union(t, s)
+    df_pic_comp = boletas_por_comp(df_pic, df_trans, comp_de)
 
-# IDs con boleta
-pic_ids = set()
-if not df_pic.empty and "transactionID" in df_pic.columns:
-    pic_ids = set(df_pic["transactionID"].astype(str).unique())
-    for pid in pic_ids:
-        dsu.add(pid)
+    file_to_fecha = {}
+    if not df_pic_comp.empty and {"pictureFileName", "_fecha"}.issubset(set(df_pic_comp.columns)):
+        aux_ft = df_pic_comp.dropna(subset=["pictureFileName", "_fecha"]).copy()
+        aux_ft = aux_ft.sort_values("_fecha", ascending=False).drop_duplicates(subset=["pictureFileName"], keep="first")
+        file_to_fecha = dict(zip(aux_ft["pictureFileName"], aux_ft["_fecha"]))
 
-df_trans["comp_id"] = df_trans["tid_str"].apply(dsu.find)
+    comp_latest_date = {}
+    comp_to_files = {}
+    if not df_pic_comp.empty:
+        comp_latest_date = df_pic_comp.groupby("comp_id")["_fecha"].max().to_dict()
+        comp_to_files = df_pic_comp.groupby("comp_id")["pictureFileName"].apply(list).to_dict()
 
-# componentes con boleta (a nivel comp_id)
-comps_con_boleta = set(dsu.find(pid) for pid in pic_ids) if pic_ids else set()
+    return {
+        "df_trans": df_trans,
+        "comercio_por_item": comercio_por_item,
+        "df_pic": df_pic,
+        "comps_con_boleta": comps_con_boleta,
+        "df_pic_comp": df_pic_comp,
+        "file_to_fecha": file_to_fecha,
+        "comp_latest_date": comp_latest_date,
+        "comp_to_files": comp_to_files,
+        "ruta_indice": ruta_indice,
+        "indice_fuzzy": indice_fuzzy,
+        "comp_incremental": comp_incremental,
+        "memoria_tablas": memoria,
+    }
 
-df_base = df_trans.copy()
 
-dbg("Inputs", {"producto": nombre_producto, "producto_norm": nombre_normalizado, "solo_con_boleta": solo_con_boleta, "n_resultados_max": int(n_resultados)})
+hoy = datetime.now().strftime("%Y-%m-%d")
+datos = construir_datos_snapshot(snapshot_version, ruta_fydb, hoy)
+df_trans = datos["df_trans"]
+comercio_por_item = datos["comercio_por_item"]
+df_pic = datos["df_pic"]
+comps_con_boleta = datos["comps_con_boleta"]
+df_pic_comp = datos["df_pic_comp"]
+file_to_fecha = datos["file_to_fecha"]
+comp_latest_date = datos["comp_latest_date"]
+comp_to_files = datos["comp_to_files"]
+ruta_indice = datos["ruta_indice"]
+indice_fuzzy = datos["indice_fuzzy"]
+dbg("Componentes", {"incremental": datos["comp_incremental"], "con_boleta": len(comps_con_boleta)})
+dbg("Memoria tablas .fydb", {
+    t: {**r, "ahorro_%": round(100 * (1 - r["bytes_tipados"] / max(1, r["bytes_leidos"])), 1)}
+    for t, r in datos["memoria_tablas"].items()
+})
 
 
 # -------------------------
-# Boletas por componente (ordenadas por fecha)
+# UI búsqueda
 # -------------------------
-def boletas_por_comp(df_pic_in: pd.DataFrame) -> pd.DataFrame:
-    if df_pic_in.empty or "transactionID" not in df_pic_in.columns or "pictureFileName" not in df_pic_in.columns:
-        return pd.DataFrame(columns=["comp_id", "pictureFileName", "_fecha", "tid_str"])
+nombre_producto = st.text_input("Producto a buscar:")
+solo_con_boleta = st.radio("¿Mostrar sólo registros con boleta?", options=["Sí", "No"], index=0)
+n_resultados = st.number_input("¿Cuántas compras quieres ver? (máximo)", min_value=1, max_value=50, value=3)
+modo_lazy = st.checkbox("Cargar boletas sólo al abrirlas", value=True)
 
-    aux = df_pic_in[["transactionID", "pictureFileName"]].copy()
-    aux["tid_str"] = aux["transactionID"].astype(str)
+if not nombre_producto:
+    st.info("Ingresa un producto para comenzar.")
+    detener()
 
-    aux = aux.merge(df_trans[["tid_str", "date"]], on="tid_str", how="left")
-    aux["_fecha"] = pd.to_datetime(aux["date"], errors="coerce")
-    aux = aux.dropna(subset=["pictureFileName"])
-    aux["comp_id"] = aux["tid_str"].apply(dsu.find)
+# Estado descartados (por componente)
+if "descartados_comp" not in st.session_state:
+    st.session_state.descartados_comp = set()
 
-    aux = aux.sort_values("_fecha", ascending=False)
-    return aux
+nombre_normalizado = normalizar(nombre_producto)
+
+# Historial en memoria
+row_by_key, registro_by_key = cargar_historial(worksheet)
+cola = cola_escrituras(st.secrets["SHEETS_ID"])
+dbg("Cola Sheets", {"pendientes": cola.pendientes()})
+
+# --- RESUMEN EN CABECERA (tabla materializada del espejo, por producto y unidad más frecuente) ---
+hay_historial, res = espejo_historial(st.secrets["SHEETS_ID"]).resumen_producto(nombre_normalizado)
+dbg("Historial: Precio/Cantidad no numéricos", espejo_historial(st.secrets["SHEETS_ID"]).diagnostico_numeros())
+
+if hay_historial:
+    if res is None:
+        st.info("No hay unidades registradas en el historial para calcular el resumen.")
+    elif res["compras"]:
+        precio_prom = res["suma_pc"] / res["suma_c"]
+
+        # Consumo mensual sin la última compra (el rango sí incluye su fecha)
+        if res["consumo_n"] > 1:
+            unidades_consumidas = res["consumo_suma_c"] - res["cant_ultima"]
+            dias = max(1, (res["consumo_fin"] - res["consumo_ini"]).days)
+            consumo_mensual_ajustado = unidades_consumidas / (dias / 30)
+        else:
+            unidades_consumidas = 0.0
+            consumo_mensual_ajustado = 0.0
+
+        st.markdown(f"<div style='background-color:#e6f4ea; padding:0.6em; border-radius:0.5em;'>"
+        f"<b>📊 Resumen Histórico Global ({res['unidad']})</b></div>",
+        unsafe_allow_html=True)
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown(
+                f"""<div>
+                <b>Rango:</b> {res['fecha_ini'].strftime('%d/%m/%y')} al {res['fecha_fin'].strftime('%d/%m/%y')}<br>
+                <b>Unidades consumidas:</b> {unidades_consumidas:.2f}
+                </div>""",
+                unsafe_allow_html=True
+            )
 
+        with col2:
+            st.markdown(
+                f"""<div>
+                <b>Precio Unitario:</b><br>
+                <span style='margin-left: 10px;'>Min: <span style='color: green; font-family: monospace;'>{formatear_pesos(res['precio_min'])}</span></span><br>
+                <span style='margin-left: 10px;'>Máx: <span style='color: red; font-family: monospace;'>{formatear_pesos(res['precio_max'])}</span></span><br>
+                <span style='margin-left: 10px;'>Prom. Ponderado: <span style='color: blue; font-family: monospace;'>{formatear_pesos(precio_prom)}</span></span>
+                </div>""",
+                unsafe_allow_html=True
+            )
 
-df_pic_comp = boletas_por_comp(df_pic)
+        st.markdown(
+            f"""<div style="background-color:#eaf4fc; padding: 0.75em; border-radius: 0.5em;">
+                💡 <b>Consumo mensual promedio:</b>
+                <span style='font-family: monospace;'>{consumo_mensual_ajustado:.2f} {res['unidad']} / mes</span><br>
+                <small style='color: #555;'>Última compra no incluida en el consumo</small>
+            </div>""",
+            unsafe_allow_html=True
+        )
+else:
+    st.info("Aún no hay historial para este producto. Los datos aparecerán aquí una vez que guardes la primera compra.")
 
-file_to_fecha = {}
-if not df_pic_comp.empty and {"pictureFileName", "_fecha"}.issubset(set(df_pic_comp.columns)):
-    aux_ft = df_pic_comp.dropna(subset=["pictureFileName", "_fecha"]).copy()
-    aux_ft = aux_ft.sort_values("_fecha", ascending=False).drop_duplicates(subset=["pictureFileName"], keep="first")
-    file_to_fecha = dict(zip(aux_ft["pictureFileName"], aux_ft["_fecha"]))
+df_base = df_trans
 
-comp_latest_date = {}
-comp_to_files = {}
-if not df_pic_comp.empty:
-    comp_latest_date = df_pic_comp.groupby("comp_id")["_fecha"].max().to_dict()
-    comp_to_files = df_pic_comp.groupby("comp_id")["pictureFileName"].apply(list).to_dict()
+dbg("Inputs", {"producto": nombre_producto, "producto_norm": nombre_normalizado, "solo_con_boleta": solo_con_boleta, "n_resultados_max": int(n_resultados)})
 
 
 def orden_comp(comp_id: str) -> pd.Timestamp:
     return comp_latest_date.get(comp_id, pd.Timestamp.min)
 
 
+# -------------------------
+# Caché LRU de rankings de búsqueda
+# -------------------------
+class CacheBusquedas:
+    def __init__(self, max_entradas: int):
+        self.max_entradas = max_entradas
+        self.lock = threading.Lock()
+        self.entradas: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def obtener(self, clave: tuple):
+        with self.lock:
+            if clave in self.entradas:
+                self.entradas.move_to_end(clave)
+                self.hits += 1
+                return self.entradas[clave]
+            self.misses += 1
+            return None
+
+    def guardar(self, clave: tuple, valor):
+        with self.lock:
+            self.entradas[clave] = valor
+            self.entradas.move_to_end(clave)
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+
+    def estadisticas(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entradas": len(self.entradas)}
+
+
+@st.cache_resource
+def cache_busquedas() -> CacheBusquedas:
+    return CacheBusquedas(BUSQUEDAS_CACHE_MAX)
+
+
 # -------------------------
 # TOP: 1 fila por componente
 # -------------------------
-def construir_top() -> pd.DataFrame:
-    base_full = df_base[~df_base["comp_id"].isin(st.session_state.descartados_comp)].copy()
+def ranking_busqueda(consulta_norm: str, solo_boleta: str) -> tuple[np.ndarray, bool]:
+    """Ranking completo como posiciones en df_base (1 por componente, boleta más reciente primero) y aviso 'sin boleta'.
+
+    No depende de descartes ni de N: se cachea y luego sólo se filtra/corta.
+    Sólo posiciones, no filas: una consulta corta puede coincidir con casi todo df_base.
+    """
+    vacio = np.empty(0, dtype=np.int64)
+    posiciones = buscar_en_indice(ruta_indice, consulta_norm)
+    if posiciones is None:
+        coincide = df_base["texto_busqueda_norm"].str.contains(consulta_norm, na=False, regex=False)
+        posiciones = np.flatnonzero(coincide.to_numpy())
+    else:
+        posiciones = np.asarray(posiciones, dtype=np.int64)
 
-    matches = base_full[base_full["notes_norm"].str.contains(nombre_normalizado, na=False)].copy()
+    if not len(posiciones) and consulta_norm:
+        puntajes = indice_fuzzy.buscar(consulta_norm)
+        if puntajes:
+            posiciones = np.flatnonzero(df_base["notes_norm"].isin(list(puntajes)).to_numpy())
 
-    if matches.empty and nombre_normalizado:
-        cand = base_full[base_full["notes_norm"].str.len() > 0].copy()
-        if not cand.empty:
-            cand["score"] = cand["notes_norm"].apply(lambda x: fuzz.partial_ratio(nombre_normalizado, x))
-            matches = cand[cand["score"] >= 80].copy()
+    if not len(posiciones):
+        return vacio, False
 
-    if matches.empty:
-        return pd.DataFrame(columns=base_full.columns)
+    comps = df_base["comp_id"].to_numpy()[posiciones]
+    if solo_boleta == "Sí":
+        con_boleta = pd.Series(comps).isin(comps_con_boleta).to_numpy()
+        if not con_boleta.any():
+            return vacio, True
+        posiciones, comps = posiciones[con_boleta], comps[con_boleta]
 
-    if solo_con_boleta == "Sí":
-        matches_con_boleta = matches[matches["comp_id"].isin(comps_con_boleta)].copy()
-        if matches_con_boleta.empty and not matches.empty:
-            st.warning(
-                f"Se encontraron compras con '{nombre_producto}', pero ninguna tiene boleta. "
-                f"Desactiva el filtro 'Sólo con boleta' para verlas."
-            )
-            return pd.DataFrame(columns=base_full.columns)
-        matches = matches_con_boleta
+    comps_sorted = sorted(dict.fromkeys(comps), key=orden_comp, reverse=True)  # empates: orden de aparición
+    rank = {c: i for i, c in enumerate(comps_sorted)}
+    aux = pd.DataFrame({"pos": posiciones, "comp_id": comps, "date": df_base["date"].to_numpy()[posiciones]})
+    aux["__comp_rank"] = aux["comp_id"].map(rank)
+    aux = aux.sort_values(["__comp_rank", "date"], ascending=[True, False])
+    return aux.drop_duplicates(subset=["comp_id"], keep="first")["pos"].to_numpy(), False
 
-    comps_sorted = sorted(matches["comp_id"].unique(), key=orden_comp, reverse=True)
-    comps_top = comps_sorted[: int(n_resultados)]
 
-    df_res = matches[matches["comp_id"].isin(comps_top)].copy()
-    rank = {c: i for i, c in enumerate(comps_top)}
-    df_res["__comp_rank"] = df_res["comp_id"].map(rank)
-    df_res = df_res.sort_values(["__comp_rank", "date"], ascending=[True, False])
-    return df_res.drop_duplicates(subset=["comp_id"], keep="first").drop(columns=["__comp_rank"])
+def construir_top() -> pd.DataFrame:
+    cache = cache_busquedas()
+    clave = (nombre_normalizado, solo_con_boleta, snapshot_version, hoy)
+    resultado = cache.obtener(clave)
+    if resultado is None:
+        resultado = ranking_busqueda(nombre_normalizado, solo_con_boleta)
+        cache.guardar(clave, resultado)
+    ranking, sin_boleta = resultado
+
+    if sin_boleta:
+        st.warning(
+            f"Se encontraron compras con '{nombre_producto}', pero ninguna tiene boleta. "
+            f"Desactiva el filtro 'Sólo con boleta' para verlas."
+        )
+    # Descartes y N sólo cortan el ranking cacheado (no lo invalidan)
+    comps = df_base["comp_id"].to_numpy()[ranking]
+    ranking = ranking[~pd.Series(comps).isin(st.session_state.descartados_comp).to_numpy()]
+    return df_base.iloc[ranking[: int(n_resultados)]]
 
 
 top = construir_top()
 if top.empty:
     st.warning("No se encontraron registros suficientes con los criterios seleccionados.")
-    st.stop()
+    detener()
 
 
 # -------------------------
 # Render resultados
 # -------------------------
+def boletas_visibles(comp_id: str) -> list[str]:
+    # Modo lazy: nada hasta abrir la tarjeta; al abrirla, sólo la boleta más reciente
+    files = comp_to_files.get(comp_id, [])
+    if not modo_lazy:
+        return files
+    if not st.session_state.get(f"verbol_{comp_id}"):
+        return []
+    return files if st.session_state.get(f"verbol_todas_{comp_id}") else files[:1]
+
+
+# Las descargas visibles arrancan ya; cada tarjeta espera sólo por sus propias boletas
+futuros_boletas = prefetch_boletas([f for c in top["comp_id"] for f in boletas_visibles(str(c))])
 trans_ids_mostradas = set()
 
 for _, row in top.iterrows():
@@ -567,15 +2122,11 @@ for _, row in top.iterrows():
 
     # Registro existente único por (producto, transacción)
     key_par = (normalizar(nombre_producto), tid)
-    fila_existente = row_by_key.get(key_par)
-    registro_existente = None
-    if fila_existente and not df_hist.empty:
-        aux_reg = df_hist[
-            (df_hist["prod_norm"] == nombre_normalizado)
-            & (df_hist["transactionsTableID"].astype(str).str.strip() == tid)
-        ]
-        if not aux_reg.empty:
-            registro_existente = aux_reg.iloc[0].to_dict()
+    estado_cola = cola.estado(nombre_normalizado, tid)
+    # Sólo un guardado pendiente aporta fila: los confirmados ya están en el espejo, que manda
+    fila_en_cola = estado_cola["fila"] if estado_cola and estado_cola["estado"] == "pendiente" else None
+    fila_existente = row_by_key.get(key_par) or fila_en_cola
+    registro_existente = registro_by_key.get(key_par)
 
     # Defaults si existe
     precio_default = to_float(registro_existente.get("Precio")) if registro_existente else 0.0
@@ -594,21 +2145,41 @@ for _, row in top.iterrows():
         # Nota antes de boletas
         st.markdown(f"**Nota:** {row.get('notes', '')}")
 
+        # Estado del último guardado de esta compra (cola → Sheets)
+        if estado_cola and estado_cola["estado"] == "pendiente":
+            aviso = "⏳ Guardado pendiente de sincronizar con Sheets"
+            if estado_cola["error"]:
+                aviso += f" (reintento {estado_cola['intentos']}: {estado_cola['error']})"
+            st.caption(aviso)
+        elif estado_cola and estado_cola["estado"] == "confirmado":
+            st.caption(f"✅ Confirmado en Sheets (fila {estado_cola['fila']})")
+
         # Boletas del componente (más recientes primero)
         files = comp_to_files.get(comp_id, [])
         if not files:
             st.info("No hay boleta asociada a esta compra (ni a sus transacciones hermanas).")
         else:
-            for i, file_name in enumerate(files):
+            visibles = boletas_visibles(comp_id)
+            if modo_lazy:
+                st.checkbox(f"Mostrar boleta ({len(files)} asociada/s)", key=f"verbol_{comp_id}")
+                if visibles and len(files) > 1:
+                    st.checkbox(f"Mostrar las {len(files)} boletas", key=f"verbol_todas_{comp_id}")
+            for i, file_name in enumerate(visibles):
                 fecha_file = file_to_fecha.get(file_name)
                 if pd.notna(fecha_file):
                     st.markdown(f"**Fecha transacción:** {fecha_file.strftime('%d-%m-%Y %H:%M')}")
                 else:
                     st.markdown("**Fecha transacción:** (sin fecha disponible)")
 
-                ruta = descargar_archivo_boleta(file_name)
-                if ruta:
-                    mostrar_boleta_desde_ruta(ruta, key_suffix=f"{comp_id}_{i}")
+                try:
+                    boleta = futuros_boletas[file_name].result()
+                except Exception as e:
+                    st.error(f"No se pudo descargar la boleta {file_name}: {e}")
+                    continue
+                if boleta:
+                    mostrar_boleta_desde_ruta(
+                        boleta["ruta"], key_suffix=f"{comp_id}_{i}", vistas=boleta["vistas"], nombre=boleta["nombre"]
+                    )
                 else:
                     st.info("Boleta referenciada pero no encontrada en Drive (Pictures).")
 
@@ -635,7 +2206,7 @@ for _, row in top.iterrows():
     with st.form(f"form_{comp_id}_{tid}"):
         actualizar_existente = actualizar
 
-        fila_existente = row_by_key.get((nombre_normalizado, tid))
+        fila_existente = row_by_key.get((nombre_normalizado, tid)) or fila_en_cola
         
         if fila_existente:
             st.warning(f"⚠️ Ya existe registro para esta compra (Fila {fila_existente}).")
@@ -663,11 +2234,7 @@ for _, row in top.iterrows():
     # ===== DEFINICIÓN OBLIGATORIA DE FILA (SIEMPRE) =====
         fecha_modificacion = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        comercio = ""
-        if not pd.isnull(row.get("itemID")):
-            item_row = df_item[df_item["itemTableID"] == row["itemID"]]
-            if not item_row.empty:
-                comercio = item_row.iloc[0].get("itemName", "")
+        comercio = comercio_por_item.get(row.get("itemID"), "")
 
         fila = [
             nombre_producto,
@@ -681,28 +2248,22 @@ for _, row in top.iterrows():
             archivo_img,
             fecha_modificacion,
         ]
-        cargar_historial.clear()
-        df_hist, row_by_key = cargar_historial(worksheet)
-        fila_existente = row_by_key.get((nombre_normalizado, tid))
+        # decidir si actualiza o inserta (unicidad por (producto_norm, tid)), sólo con datos locales
+        if fila_existente and not actualizar:
+            st.info("Este registro ya existe. Marca 'Actualizar' si deseas modificarlo.")
+            detener()
 
-        # decidir si actualiza o inserta (unicidad por (producto_norm, tid))
+        # Se registra en la cola local y se vuelve de inmediato; el envío a Sheets va en segundo plano
+        cola.encolar(nombre_normalizado, tid, fila_existente, fila)
         if fila_existente:
-            if actualizar:  # o actualizar_existente si lo igualaste a 'actualizar'
-                worksheet.update(f"A{fila_existente}:J{fila_existente}", [fila])
-                st.session_state.flash_ok = "Registro actualizado en HistorialCompras."
-                time.sleep(1)
-                cargar_historial.clear()
-                st.rerun()
-            else:
-                st.info("Este registro ya existe. Marca 'Actualizar' si deseas modificarlo.")
-                st.stop()
+            st.session_state.flash_ok = "Registro actualizado (sincronizando con HistorialCompras...)."
         else:
-            all_rows = worksheet.get_all_values()
-            worksheet.insert_row(fila, index=len(all_rows) + 1)
-            st.session_state.flash_ok = "¡Compra registrada!"
-            time.sleep(1)
-            cargar_historial.clear()
-            st.rerun()
+            st.session_state.flash_ok = "¡Compra registrada! (sincronizando con HistorialCompras...)"
+        st.rerun()
 
     # ===================================================
 
+dbg("Caché boletas", boletas_cache.estadisticas())
+dbg("Caché derivados", derivados_cache.estadisticas())
+dbg("Caché búsquedas", cache_busquedas().estadisticas())
+mostrar_panel_api()